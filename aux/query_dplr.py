@@ -29,6 +29,7 @@
 #
 ################################################################################
 
+import numpy as np
 import rpy2.robjects as ro
 from rpy2.robjects.packages import importr
 import rpy2.rlike.container as rlc
@@ -41,8 +42,11 @@ def logistic_regression(eps, parms, result):
     types = map(lambda cn : result['setd']['attributes'][cn]['type'], col_names)
     pdict = dict(parms)
 
-    # create dictionary of R vectors
-    cols = zip(*list(result['data']))    
+    # create dictionary of R vectors, categorical codes replaced by their values
+    labels = result['labels']
+    cols = map(lambda cn : (np.array(labels[cn], dtype=object)[result['columns'][cn]]
+                            if labels.has_key(cn) else result['columns'][cn]).tolist(),
+               col_names)
     tfun = [ro.FactorVector, ro.IntVector, ro.FloatVector]
     dfd = rlc.OrdDict(zip(col_names, map(lambda (tt,cc): tfun[tt](cc), zip(types, cols))))
 
@@ -71,6 +75,7 @@ proc_logistic_regression = {
     'name': 'Logistic_Regression',
     'f' : logistic_regression,
     'query_edit' : lambda sel, pro : ([], [] if len(pro) == 1 else pro),
+    'input' : 'columns',
     'meta' : logistic_regression_meta 
 }
 processors = {'Logistic_Regression' : proc_logistic_regression }
@@ -64,6 +64,9 @@ if __name__ == '__main__':
                         help = 'display version number and exit.')
     parser.add_argument('-n', "--nowrite", action='store_true', 
                         help = 'disallow writing results to file.')
+    parser.add_argument("--session", action='store_true', 
+                        help = 'use GPG only to set up a session key with the server,'
+        ' and protect further messages with this key.')
     parser.add_argument('-d', "--debug", action='store_true', 
                         help = 'display debug info.')
 
@@ -97,7 +100,8 @@ if __name__ == '__main__':
         factory = init_factory(gpg, args.key, args.query_server_key,
                                silent = args.filter,
                                alias = args.user,
-                               allow_write=not args.nowrite)
+                               allow_write=not args.nowrite,
+                               session = args.session)
 
         reactor.connectTCP(args.query_server_address, args.query_server_port,
                            factory)
@@ -35,7 +35,7 @@ import sqlalchemy as sa
 from sqlalchemy import Table, Column, Integer, String, Float, DateTime, MetaData, ForeignKey
 
 from dpdq.gpgutils import finduserinfo, findfp
-from dpdq.qp.backend import make_risk_tables
+from dpdq.qp.backend import make_risk_tables, verify_totals
 
 
 if __name__ == "__main__":    
@@ -57,6 +57,9 @@ if __name__ == "__main__":
     parser.add_argument('-u', '--update',  action = 'store_true', help="Update existing user instead of add")
     parser.add_argument('-k', '--kill', action = 'store_true', help="Delete existing user")
     parser.add_argument('-i', '--info', action = 'store_true', help="Show user information and history")        
+    parser.add_argument('-V', '--verify', action = 'store_true',
+                        help="Recompute the user's total risk expenditure from the history and"
+                        " correct the stored total if it differs")
     parser.add_argument('-v', "--version", action='store_true',
                         help = 'display version number and exit.')
     parser.add_argument('-n', "--nokey", action='store_true',
@@ -96,7 +99,7 @@ if __name__ == "__main__":
 
     try:        
         metadata = MetaData(engine)
-        (users, history) = make_risk_tables(metadata)
+        (users, history, totals) = make_risk_tables(metadata)
     except Exception as e:
         sys.stderr.write('Could not get/create tables from ' + args.database_url + '. Schema mismatch?\n'
                          + str(e))
@@ -109,17 +112,24 @@ if __name__ == "__main__":
             conn.execute(users.update().values(tt=args.totalthreshold, qt = args.querythreshold).where(users.c.id == userkey))
         elif args.kill:
             conn.execute(history.delete().where(history.c.id == userkey))
+            conn.execute(totals.delete().where(totals.c.id == userkey))
             conn.execute(users.delete().where(users.c.id == userkey))        
         elif args.info:
             print "User", args.user, "info:"        
             for row in conn.execute(users.select().where(users.c.id == userkey)).fetchall():
                 print row
+            for row in conn.execute(totals.select().where(totals.c.id == userkey)).fetchall():
+                print "Total risk expenditure:", row[1]
             print "------------------\nHistory:"
             for row in conn.execute(history.select().where(history.c.id == userkey)).fetchall():
                 print row
+        elif args.verify:
+            for (k, stored, spent) in verify_totals(conn, users, history, totals, userkey, True):
+                print "Corrected total for", k, "from", stored, "to", spent
         else:
             conn.execute(users.insert().values(id=userkey, tt=args.totalthreshold, qt = args.querythreshold,
                                       info=userinfo))
+            conn.execute(totals.insert().values(id=userkey, spent=0.0))
         print 'Ok.'
         conn.close()
     except Exception as e:
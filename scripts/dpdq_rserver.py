@@ -51,6 +51,7 @@
 
 if __name__ == "__main__":    
     import sys
+    import multiprocessing
     import argparse as ap
     import logging
     from twisted.internet import reactor
@@ -59,6 +60,7 @@ if __name__ == "__main__":
     from dpdq import Version
     from dpdq.ra.policy import policy, policies
     from dpdq.ra.rproto import init_factory
+    from dpdq.gpgproto import init_crypto
 
     parser = ap.ArgumentParser(description=('Risk Accounting Server (version: ' + Version +').\n' +
                                             "This program answers requests about users' privacy risk history and " +
@@ -79,6 +81,14 @@ if __name__ == "__main__":
         ' state of the accountant is written to (default: "%(default)s").')
     parser.add_argument("-m", "--module", type=str, default=None,
                         help = 'a python module that contains additional policies (default: "%(default)s").')
+    parser.add_argument('-d', "--batch_delay", type=float, default=0,
+                        help = 'seconds to collect granted expenditures before writing them to the'
+        ' risk database in one transaction (default: %(default)s).')
+    parser.add_argument('-b', "--batch_size", type=int, default=100,
+                        help = 'write collected expenditures as soon as this many are pending (default: %(default)d).')
+    parser.add_argument("--crypto_workers", type=int, default=multiprocessing.cpu_count(),
+                        help = 'the number of threads GPG encryption and decryption are run in.'
+                        ' If 0, GPG is run in the main thread (default: the number of CPUs).')
     parser.add_argument('-v', "--version", action='store_true',
                         help = 'display version number and exit.')
 
@@ -93,6 +103,7 @@ if __name__ == "__main__":
                         format='%(asctime)s:%(name)s:%(levelname)s:%(message)s')
 
     gpg = gnupg.GPG(homedir=args.gpghome)
+    init_crypto(max(0, args.crypto_workers))
    
     print "Starting Risk Accountant! "
     print "GPG directory:", args.gpghome
@@ -100,9 +111,11 @@ if __name__ == "__main__":
     print "risk database:", args.database_url
     print "port:", args.risk_server_port
     print "policy:", args.enforce_policy
+    print "batch delay/size:", args.batch_delay, args.batch_size
 
     factory = init_factory(gpg, args.key, args.database_url,
-                           args.enforce_policy, args.module)
+                           args.enforce_policy, args.module,
+                           args.batch_delay, args.batch_size)
 
     reactor.listenTCP(args.risk_server_port, factory)
     reactor.run()
@@ -36,8 +36,10 @@ if __name__ == '__main__':
     from twisted.web import server
     from twisted.internet import reactor
     from dpdq.wc.resource import init_resource
+    from dpdq.gpgproto import init_crypto
 
     import sys
+    import multiprocessing
     import argparse as ap
     from dpdq import Version
     import urllib2
@@ -81,6 +83,18 @@ if __name__ == '__main__':
                         ' If not supplied %(default)s is used.')
     parser.add_argument('-v', "--version", action='store_true', 
                         help = 'display version number and exit.')
+    parser.add_argument("--crypto_workers", type=int, default=multiprocessing.cpu_count(),
+                        help = 'the number of threads GPG encryption of requests to the query server and decryption are run in.'
+                        ' If 0, GPG is run in the main thread (default: the number of CPUs).')
+    parser.add_argument("--session", action='store_true', 
+                        help = 'use GPG only to set up a session key with the query server,'
+                        ' and protect further messages with this key.')
+    parser.add_argument("--qp_connections", type=int, default=2,
+                        help = 'the number of connections kept to each query server (default: %(default)d).')
+    parser.add_argument("--max_in_flight", type=int, default=16,
+                        help = 'the maximum number of requests in flight on a connection to a query server.'
+                        ' Should not exceed the query server\'s --max_in_flight. Further requests wait'
+                        ' (default: %(default)d).')
     parser.add_argument('-d', "--debug", action='store_true', 
                         help = 'display debug info.')
 
@@ -111,9 +125,13 @@ if __name__ == '__main__':
 
 
     try:
+        init_crypto(max(0, args.crypto_workers))
         root = init_resource(args.gpghome, args.key, args.query_server_key,
                              known_hosts, args.infopage,
-                             args.user, args.use_alias_fingerprint)
+                             args.user, args.use_alias_fingerprint,
+                             args.session,
+                             max(1, args.qp_connections),
+                             max(1, args.max_in_flight))
     except Exception as e:
         sys.stderr.write('Could not initialize web server: ' +
                          str(e) + '\n')
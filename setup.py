@@ -58,6 +58,7 @@ setup(name=pname,
                           'twisted >= 12.0.0',
                           'texttable >= 0.8.1',
                           'numpy >= 1.6.1',
-                          'jinja2 >= 2.7']
+                          'jinja2 >= 2.7'],
+      extras_require = {'session' : ['cryptography']}
       )
 
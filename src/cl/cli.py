@@ -96,6 +96,14 @@ class Cli(Cmd):
         self.outfile = line.strip()
         return True
 
+    def do_estimate(self, line):
+        '''estimate  -- ask the query server for the expected cost of the query, without running it or incurring risk.'''
+        if self.data == None or self.type == None:
+            self.print_('Cannot estimate without setting: dataset, query type')
+            return False
+        self.qtype = 'estimate'
+        return True
+
     def do_quit(self, line):
         '''quit  -- quit without sending query.'''
         self.exit = True
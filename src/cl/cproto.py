@@ -101,9 +101,11 @@ class State:
     def __init__(self, gpg, me, qp,
                  silent = False,
                  alias = None,
-                 allow_write=True):
+                 allow_write=True,
+                 session = False):
 
         self.gpg = gpg # gpg instance
+        self.session = session # use a session channel
         self.me = me # my key identifier
         self.qp = qp # query processor identifier
         self.silent = silent
@@ -128,7 +130,8 @@ class ClientProtocol(GPGProtocol):
                              state.gpg,
                              state.me,
                              state.qp, # talk to qp 
-                             [state.qp]) # only allow responses from this qp
+                             [state.qp], # only allow responses from this qp
+                             session = state.session)
         self.state = state
         self.state.set_user(self.my_key)
         self.handler = Handler(self)
@@ -138,8 +141,7 @@ class ClientProtocol(GPGProtocol):
 
     def connectionMade(self):
         self.state.print_(greeting)
-        self.handler.request = QPRequest(QP_META)
-        self.sendMessage(self.handler.request)
+        self.handler.send(QPRequest(QP_META))
 
 
 class QPClientFactory(ClientFactory):
@@ -174,13 +176,16 @@ class Handler:
         self.request = None
         self.user_id = None
         self.pending = None
-        self.handle_response = [self.handle_meta,
-                                self.handle_info,
-                                self.handle_risk]
+        self.handle_response = {QP_META : self.handle_meta,
+                                QP_INFO : self.handle_info,
+                                QP_RISK : self.handle_risk,
+                                QP_ESTIMATE : self.handle_estimate}
         self.make_request = {'info' : self.make_info,
-                             'risk' : self.make_risk }
+                             'risk' : self.make_risk,
+                             'estimate' : self.make_estimate }
         self.request = None
         self.meta = None
+        self.last_id = 0
 
         self.print_ = self.proto.state.print_
 
@@ -193,6 +198,10 @@ class Handler:
             self.proto.transport.loseConnection()
             return
 
+        if r.rid != None and r.rid != self.request.rid:
+            self.print_('Ignoring response to an earlier request.\n')
+            return
+
         ### handle reponse
         try:
             if r.status != QP_OK:
@@ -258,6 +267,11 @@ class Handler:
             request = self.make_request[self.cli.qtype]()
 
         # send request
+        self.send(request)
+
+    def send(self, request):
+        self.last_id += 1
+        request.rid = self.last_id
         self.request = request
         self.proto.sendMessage(request)
 
@@ -269,6 +283,11 @@ class Handler:
     def make_risk(self):
         return QPRequest(QP_RISK, self.proto.state.user, 0, None)
 
+    def make_estimate(self):
+        request = self.make_info()
+        request.type = QP_ESTIMATE
+        return request
+
     def handle_meta(self, r):
         self.meta = r.response
 
@@ -277,6 +296,10 @@ class Handler:
                    'Cumulative max allowed risk: ' + str(r.response['tt']) + '\n'
                    'Per query allowed risk: ' + str(r.response['qt']) + '\n')
 
+    def handle_estimate(self, r):
+        for k,v in sorted(r.response.items()):
+            self.print_(str(k) + ": " + str(v) + '\n')
+
     def handle_info(self, r):
         response = r.response
         if type(response) == dict:
@@ -306,12 +329,14 @@ class Handler:
 def init_factory(gpg, me, qp,
                    silent = False,
                    alias = None,
-                   allow_write=True):
+                   allow_write=True,
+                   session = False):
 
      state = State(gpg, me, qp,
                    silent = silent,
                    alias = alias,
-                   allow_write=allow_write)
+                   allow_write=allow_write,
+                   session = session)
 
      return QPClientFactory(state)
 
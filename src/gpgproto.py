@@ -30,17 +30,143 @@
 ################################################################################
 
 from twisted.protocols.basic import NetstringReceiver
+from twisted.internet import reactor, threads
+from twisted.internet.defer import succeed, execute
+from twisted.python.failure import Failure
+from twisted.python.threadpool import ThreadPool
+from logging import info, error
+from time import time
 import gnupg
+import os
+from struct import pack, unpack
+from bisect import bisect_left
+from binascii import hexlify, unhexlify
+try:
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+    from cryptography.exceptions import InvalidTag
+except ImportError: # sessions are not available
+    AESGCM = None
 from dpdq.gpgutils import wrap, unwrap, findfp
 
 class fdict(dict): # like defaultdict(False) except does not store
     def __missing__(self, key):
         return False
 
+#### Crypto pool. GPG is run as a subprocess by python-gnupg, so
+#### running it in threads lets several messages be encrypted or
+#### decrypted at the same time without blocking the reactor.
+
+class CryptoPool:
+    '''threads running GPG, with counts and latency histograms
+
+       If size is 0, GPG is run in the calling thread.'''
+
+    bounds = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000] # ms
+
+    def __init__(self, size = 0):
+        self.size = size
+        self.pool = None
+        self.stats = dict((op, {'count' : 0, 'time' : 0.0,
+                                'histogram' : [0] * (len(self.bounds) + 1)})
+                          for op in ['wrap', 'unwrap'])
+        if size > 0:
+            self.pool = ThreadPool(1, size, 'crypto')
+            self.pool.start()
+            reactor.addSystemEventTrigger('during', 'shutdown', self.stop)
+
+    def stop(self):
+        info(self.report())
+        self.pool.stop()
+
+    def timed(self, f, *args):
+        t = time()
+        res = f(*args)
+        return (res, time() - t)
+
+    def record(self, (res, t), op):
+        st = self.stats[op]
+        st['count'] += 1
+        st['time'] += t
+        st['histogram'][bisect_left(self.bounds, t * 1000)] += 1
+        return res
+
+    def run(self, op, f, *args):
+        '''f(*args) for operation op, returns a Deferred'''
+        if self.pool == None:
+            d = execute(self.timed, f, *args)
+        else:
+            d = threads.deferToThreadPool(reactor, self.pool, self.timed, f, *args)
+        return d.addCallback(self.record, op)
+
+    def report(self):
+        '''crypto statistics as text'''
+        lines = []
+        labels = map(lambda b : '<=' + str(b) + 'ms', self.bounds) + ['>' + str(self.bounds[-1]) + 'ms']
+        for (op, st) in sorted(self.stats.items()):
+            lines.append(op + ': ' + str(st['count']) + ' in ' + ('%.3f' % st['time']) + 's ' +
+                         ' '.join(map(lambda (l, n) : l + ':' + str(n),
+                                      filter(lambda (l, n) : n > 0,
+                                             zip(labels, st['histogram'])))))
+        return 'crypto ' + '; '.join(lines)
+
+crypto = CryptoPool()
+
+def init_crypto(size):
+    '''run GPG in a pool of size threads'''
+    global crypto
+    crypto = CryptoPool(size)
+    return crypto
+
+
+#### Session channel. The initiator sends a fresh key in a GPG
+#### encrypted and signed message. After that, messages are sent as
+#### frames: 'S' + counter + AES-GCM ciphertext and tag. The nonce is
+#### a direction prefix and the counter, so that the two directions
+#### never share a nonce, and the frame header is authenticated with
+#### the message. Frames must arrive in order. Sessions need the
+#### cryptography package.
+
+session_marker = 'DPDQ-SESSION '
+frame_tag = 'S'
+directions = {True : '\x00\x00\x00\x01', False : '\x00\x00\x00\x02'}
+
+class Session:
+    '''the AES-GCM key and counters of one end of a session channel'''
+
+    def __init__(self, key, initiator):
+        if AESGCM == None:
+            raise Exception('Sessions need the python package cryptography.')
+        self.aead = AESGCM(key)
+        self.send_prefix = directions[initiator]
+        self.recv_prefix = directions[not initiator]
+        self.sent = 0
+        self.received = 0
+
+    def seal(self, clear):
+        c = pack('>Q', self.sent)
+        self.sent += 1
+        return frame_tag + c + self.aead.encrypt(self.send_prefix + c, clear, frame_tag + c)
+
+    def open(self, frame):
+        '''the message in frame, or None if it is not authentic'''
+        if len(frame) < 25 or frame[0] != frame_tag:
+            return None
+        c = frame[1:9]
+        if unpack('>Q', c)[0] != self.received:
+            return None
+        try:
+            clear = self.aead.decrypt(self.recv_prefix + c, frame[9:], frame_tag + c)
+        except InvalidTag:
+            return None
+        self.received += 1
+        return clear
+
+
 class GPGProtocol(NetstringReceiver):
     '''Wrap NetstringReceiver in a layer of encryption. Disconnects invalids.'''
 
-    def __init__(self, gpg, me, recipient = None, peers = None, silent = True):
+    def __init__(self, gpg, me, recipient = None, peers = None, silent = True,
+                 session = False):
         '''initialize
 
         me -- identifies my own key
@@ -49,9 +175,20 @@ class GPGProtocol(NetstringReceiver):
                  messages from anyone who has a valid key are valid.
         silent -- if True then invalid messages will be silently
                   ignored. Otherwise Exception will be raised.
+        session -- if True then a session channel is set up with the
+                   first message sent, and further messages are
+                   protected with the session keys instead of GPG.
+                   Session channels set up by the peer are always
+                   accepted if the cryptography package is installed.
         '''
+        if session and AESGCM == None:
+            raise Exception('Sessions need the python package cryptography.')
         self.gpg = gpg
         self.silent = silent
+        self.session = session
+        self.session_keys = None # Session
+        self.inbox = []  # received messages in order of arrival
+        self.outbox = [] # messages to send in order of sending
 
         # find my own key
         self.me = me
@@ -78,39 +215,93 @@ class GPGProtocol(NetstringReceiver):
         '''to be overloaded by protocol user'''
         pass
 
+    def invalid(self):
+        self.inbox = []
+        self.transport.loseConnection()
+        if not self.silent:
+            raise Exception('Unknown peer.')
+
     def stringReceived(self, cipher):
+        # GPG messages are decrypted in the crypto pool, possibly
+        # several at the same time, but are handled in order of arrival.
+        # Session frames wait for preceding GPG messages, one of
+        # which may set up the session.
+        entry = [cipher, None, cipher[:1] == frame_tag] # message, clear, done
+        self.inbox.append(entry)
+        if entry[2]:
+            self.deliver()
+        else:
+            d = crypto.run('unwrap', unwrap, self.gpg, cipher)
+            d.addBoth(self.unwrapped, entry)
 
-        clear_in = unwrap(self.gpg, cipher)
-        if clear_in == None:
-            self.transport.loseConnection()
-            if not self.silent:
-                raise Exception('Unknown peer.')
-            else:
-                return
+    def unwrapped(self, clear_in, entry):
+        if isinstance(clear_in, Failure):
+            error('unwrap failed: ' + clear_in.getErrorMessage())
+            clear_in = None
+        entry[1:] = [clear_in, True]
+        self.deliver()
+
+    def deliver(self):
+        while self.inbox and self.inbox[0][2]:
+            (cipher, clear_in, _) = self.inbox.pop(0)
+            if cipher[:1] == frame_tag: # session frame
+                cleartext = None
+                if self.session_keys != None:
+                    cleartext = self.session_keys.open(cipher)
+                if cleartext == None:
+                    return self.invalid()
+                self.messageReceived(cleartext)
+                continue
+
+            if clear_in == None:
+                return self.invalid()
 
-        (cleartext, uname, fp) = clear_in
+            (cleartext, uname, fp) = clear_in
 
-        if not (self.allow_any or self.peers[fp]):
-            if not self.silent:
-                raise Exception('Unknown peer.')
-            else:
-                return
+            if not (self.allow_any or self.peers[fp]):
+                if not self.silent:
+                    raise Exception('Unknown peer.')
+                else:
+                    continue
 
-        self.peer_key = fp
-        if not self.peers[fp]:
-            self.peers[fp] = uname
+            self.peer_key = fp
+            if not self.peers[fp]:
+                self.peers[fp] = uname
 
-        self.messageReceived(cleartext)
+            if cleartext.startswith(session_marker): # peer sets up a session
+                try:
+                    self.session_keys = Session(unhexlify(cleartext[len(session_marker):]), False)
+                except Exception:
+                    return self.invalid()
+                continue
+
+            self.messageReceived(cleartext)
 
     def sendMessage(self, cleartext):
-        self.sendString(wrap(self.gpg,
-                             self.my_key,
-                             self.peer_key,
+        if self.session and self.session_keys == None:
+            key = os.urandom(32)
+            self.post(crypto.run('wrap', wrap, self.gpg, self.my_key, self.peer_key,
+                                 session_marker + hexlify(key)))
+            self.session_keys = Session(key, True)
+        if self.session_keys != None:
+            self.post(succeed(self.session_keys.seal(str(cleartext))))
+            return
+        self.post(crypto.run('wrap', wrap, self.gpg, self.my_key, self.peer_key,
                              str(cleartext)))
 
-            
-
-            
+    def post(self, d):
+        '''send the string d results in, in order of posting'''
+        entry = [None, False] # string, done
+        self.outbox.append(entry)
+        d.addBoth(self.wrapped, entry)
 
-            
-            
+    def wrapped(self, cipher, entry):
+        if isinstance(cipher, Failure):
+            error('wrap failed: ' + cipher.getErrorMessage())
+            self.transport.loseConnection()
+            cipher = None
+        entry[:] = [cipher, True]
+        while self.outbox and self.outbox[0][1]:
+            cipher = self.outbox.pop(0)[0]
+            if cipher != None:
+                self.sendString(cipher)
@@ -29,9 +29,11 @@
 #
 ################################################################################
 
-__all__ = ['findfp', 'findkey', 'finduserinfo', 'wrap', 'unwrap']
+__all__ = ['findfp', 'findkey', 'finduserinfo', 'wrap', 'unwrap', 'KeyIndex', 'key_index']
 
 import re
+import os
+import threading
 from pprint import pprint
 
 def flatten(iterables):
@@ -42,25 +44,78 @@ def flatten(iterables):
         else:
             yield it
 
+class KeyIndex:
+    '''cached listing of a key ring
+
+       Keys are indexed by fingerprint, and pattern lookups are
+       remembered. The listing is redone when one of the key ring
+       files changes. Lookups may come from several threads.'''
+
+    def __init__(self, gpg, private=False):
+        self.gpg = gpg
+        self.private = private
+        home = getattr(gpg, 'homedir', None) or getattr(gpg, 'gnupghome', None) or '.'
+        self.files = set([getattr(gpg, 'keyring', None), getattr(gpg, 'secring', None)] +
+                         [os.path.join(home, f) for f in ['pubring.gpg', 'pubring.kbx', 'secring.gpg',
+                                                          'trustdb.gpg', 'private-keys-v1.d']])
+        self.files.discard(None)
+        self.stamp = None
+        self.lock = threading.Lock()
+
+    def mtimes(self):
+        return tuple(os.stat(f).st_mtime if os.path.exists(f) else None
+                     for f in sorted(self.files))
+
+    def refresh(self):
+        stamp = self.mtimes()
+        if stamp == self.stamp:
+            return
+        self.keys = self.gpg.list_keys(self.private)
+        self.index = {}
+        for d in self.keys:
+            self.index.setdefault(d['fingerprint'], d)
+        self.found = {}
+        self.stamp = stamp
+
+    def find(self, pattern):
+        '''first key with a field matching the regular expression pattern'''
+        with self.lock:
+            self.refresh()
+            if self.index.has_key(pattern): # a fingerprint
+                return self.index[pattern]
+            return self.search(pattern)
+
+    def search(self, pattern):
+        if not self.found.has_key(pattern):
+            pat = re.compile(pattern)
+            self.found[pattern] = None
+            for d in self.keys:
+                if any([pat.match(x) for x in flatten([d[f] for f in key_fields])]):
+                    self.found[pattern] = d
+                    break
+        return self.found[pattern]
+
+key_fields = ['fingerprint', 'keyid', 'uids']
+key_indexes = {} # (key ring files, private) -> KeyIndex
+key_indexes_lock = threading.Lock()
+
+def key_index(gpg, private=False):
+    '''the KeyIndex shared by gpg instances using the same key rings'''
+    ki = KeyIndex(gpg, private)
+    k = (tuple(sorted(ki.files)), private)
+    with key_indexes_lock:
+        return key_indexes.setdefault(k, ki)
+
 def findfp(pattern, gpg, private=False):
     '''find key fingerprint corresponsing to pattern'''
-    kds = gpg.list_keys(private)
-    fields = ['fingerprint', 'keyid', 'uids']
-    pat = re.compile(pattern)
-    for d in kds:
-        if any([pat.match(x) for x in flatten([d[f] for f in fields])]):
-            return d['fingerprint']
-    return None
+    d = findkey(pattern, gpg, private)
+    if d == None:
+        return None
+    return d['fingerprint']
 
 def findkey(pattern, gpg, private=False):
     '''find key for pattern'''
-    kds = gpg.list_keys(private)
-    fields = ['fingerprint', 'keyid', 'uids']
-    pat = re.compile(pattern)
-    for d in kds:
-        if any([pat.match(x) for x in flatten([d[f] for f in fields])]):
-            return d
-    return None
+    return key_index(gpg, private).find(pattern)
 
 def finduserinfo(pattern, gpg, private=False):
     '''find username + info for pattern'''
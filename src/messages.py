@@ -37,7 +37,9 @@ QP_META = 0
 QP_INFO = 1
 QP_RISK = 2
 QP_ECHO = 3
-QP_MAX = 3
+QP_BATCH = 4
+QP_ESTIMATE = 5
+QP_MAX = 5
 
 
 # qp response codes
@@ -46,6 +48,7 @@ QP_ERROR_BUDGET = 1
 QP_ERROR_RA = 2
 QP_ERROR_QUERY = 3
 QP_ERROR_INTERNAL = 4
+QP_ERROR_BUSY = 5
 
 # ra query types
 RA_CHECK = 0
@@ -65,13 +68,15 @@ RA_DENIED = 0
 
 
 class QPRequest:
-    def __init__(self, rtype, alias = None, eps = 0, params = None):
+    def __init__(self, rtype, alias = None, eps = 0, params = None, rid = None):
         self.type = rtype
         self.eps = eps
         self.params = params
         self.alias = alias
+        self.rid = rid # request id, echoed in the response
     def __str__(self):
-        return str((self.type, self.alias, self.eps, self.params))
+        return str((self.type, self.alias, self.eps, self.params) +
+                   ((self.rid,) if self.rid != None else ()))
     @classmethod
     def parse(self, text):
         '''parse request in a safe way'''
@@ -86,12 +91,14 @@ class QPRequest:
 
 
 class QPResponse:
-    def __init__(self, status, towhat, response):
+    def __init__(self, status, towhat, response, rid = None):
         self.status = status
         self.towhat = towhat
         self.response = response
+        self.rid = rid # id of the request responded to
     def __str__(self):
-        return str((self.status, self.towhat, self.response))
+        return str((self.status, self.towhat, self.response) +
+                   ((self.rid,) if self.rid != None else ()))
     @classmethod
     def parse(self, text):
         '''parse response in a safe way'''
@@ -103,12 +110,14 @@ class QPResponse:
         return q
 
 class RAQuery:
-    def __init__(self, typ, user, eps = None):
+    def __init__(self, typ, user, eps = None, rid = None):
         self.type = typ
         self.user = user
         self.eps = eps
+        self.rid = rid # correlation id, echoed in the response
     def __str__(self):
-        return str((self.type, self.user, self.eps))
+        return str((self.type, self.user, self.eps) +
+                   ((self.rid,) if self.rid != None else ()))
     @classmethod
     def parse(self, text):
         '''parse response in a safe way'''
@@ -122,13 +131,15 @@ class RAQuery:
         return q
 
 class RAResponse:
-    def __init__(self, status, f1, tt = None, qt = None):
+    def __init__(self, status, f1, tt = None, qt = None, rid = None):
         self.status = status
         self.f1 = f1 # status, error text, or cum_risk
         self.tt = tt
         self.qt = qt
+        self.rid = rid # correlation id of the query responded to
     def __str__(self):
-        return str((self.status, self.f1, self.tt, self.qt))
+        return str((self.status, self.f1, self.tt, self.qt) +
+                   ((self.rid,) if self.rid != None else ()))
     @classmethod
     def parse(self, text):
         '''parse response in a safe way'''
@@ -152,6 +163,9 @@ def QPRAError(text):
 def QPBudgetError(text, towhat = None):
     return QPResponse(QP_ERROR_BUDGET, towhat, text)
 
+def QPBusyError(text, towhat = None):
+    return QPResponse(QP_ERROR_BUSY, towhat, text)
+
 def QPOK(text, towhat = None):
     return QPResponse(QP_OK, towhat, text)
 
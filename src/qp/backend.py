@@ -32,8 +32,13 @@
 ################################################################################
 
 __all__ = ['operators', 'CATEGORICAL', 'INTEGER', 'FLOAT', 'STRING', 'DATE',
-           'init_backend', 'query_backend', 'reinit_backend']
+           'init_backend', 'query_backend', 'reinit_backend', 'aggregates',
+           'AggregateCache', 'init_aggregate_cache', 'canonical_selection',
+           'aggregate_sources']
 
+import threading
+from collections import OrderedDict
+import numpy as np
 import sqlalchemy as sa
 from sqlalchemy import Table, Column, Integer, String, Float, DateTime, MetaData, ForeignKey
 
@@ -164,11 +169,9 @@ def get_backend_metadata(conn):
     return {'operators' : operators,
             'datasets'  : get_sets_dict(meta, conn, sets) }
 
-def make_select(meta, setd, selection, projection):
-    '''create a sqlalchemy executable select expression'''
+def make_where(table, setd, selection):
+    '''translate a predicate into a sqlalchemy where clause (or None)'''
 
-    table = meta.tables[setd['name']]
-    
     def desc(tup):
         '''translate descriptor into binary expression'''
         # checking of input could be done here, but is not...
@@ -184,18 +187,234 @@ def make_select(meta, setd, selection, projection):
                    map(desc, descs))
         return sa.not_(c) if neg else c
 
+    if not selection:
+        return None
+    return reduce(lambda x,y: x | y,
+                  map(conj, selection))
+
+# aggregates: an aggregate specification is a tuple whose first
+# element names an entry below. 'select' compiles the specification
+# into a select expression, and 'collect' executes it and returns the
+# entries that replace 'data' in the query result.
+
+def count_select(table, setd, where, projection, spec):
+    '''SELECT COUNT(*) FROM table WHERE predicate'''
+    s = sa.select([sa.func.count()]).select_from(table)
+    return s if where is None else s.where(where)
+
+def count_collect(conn, sstmt, spec):
+    '''the number of matching rows'''
+    return {'count' : int(conn.execute(sstmt).scalar())}
+
+def bin_expression(col, spec):
+    '''the bin index of a numeric column, or the column itself
+
+       spec is None or (a, b, w, nbin): the index is
+       min(floor((max(a, min(x, b)) - a)/w), nbin - 1), computed with
+       the same floating point operations as histogram.column_index,
+       so that both put a value in the same bin. The floor is taken by
+       comparing with the integers, as SQLite has no floor and CAST
+       rounds on some dialects. Constants are inlined so that the
+       expression is textually identical in SELECT and GROUP BY.'''
+    if spec == None:
+        return col
+    (a, b, w, nbin) = spec
+    if nbin < 2: # not a bare 0, which GROUP BY takes as a column position
+        return sa.literal_column('0+0')
+    num = lambda x : sa.literal_column(repr(float(x)))
+    x = sa.case([(col < num(a), num(a)), (col > num(b), num(b))], else_ = col)
+    q = (x - num(a)) / num(w)
+    return sa.case([(q < num(i + 1), sa.literal_column(str(i)))
+                    for i in range(nbin - 1)],
+                   else_ = sa.literal_column(str(nbin - 1)))
+
+def test_bins(n = 20000):
+    '''check that bin_expression bins as histogram.column_index on
+       values at and next to the bin edges'''
+    from histogram import column_index
+    engine = sa.create_engine('sqlite://')
+    metadata = MetaData(engine)
+    table = Table('t', metadata, Column('x', Float))
+    metadata.create_all()
+    conn = engine.connect()
+    failed = 0
+    for (a, b, nbin) in [(0.9, 10.9, 13), (0.1, 0.7, 7), (-3.3, 2.2, 9), (0, 1, 3)]:
+        w = float((b + float(b-a)/1000) - a)/nbin
+        edges = [a + i*w for i in range(nbin + 1)]
+        xs = sorted(set([round(x, 1) for x in np.arange(a - 1, b + 1, 0.1)] + edges +
+                        [np.nextafter(e, d) for e in edges for d in [-np.inf, np.inf]] +
+                        list(np.random.uniform(a, b, n))))
+        conn.execute(table.delete())
+        conn.execute(table.insert(), [{'x' : float(x)} for x in xs])
+        spec = (a, b, w, nbin)
+        rows = list(conn.execute(sa.select([table.c.x, bin_expression(table.c.x, spec)])))
+        expect = column_index([r[0] for r in rows], None, spec)
+        bad = filter(lambda (r, e) : r[1] != e, zip(rows, expect))
+        failed += len(bad)
+        print 'bins', spec, len(rows), 'values', len(bad), 'differ', bad[:3]
+    return failed == 0
+
+def cells_select(table, setd, where, projection, spec):
+    '''SELECT bins, COUNT(*) FROM table WHERE predicate GROUP BY bins
+
+       spec is ('cells', bins) where bins holds a bin specification
+       (see bin_expression) for each projected column.'''
+    keys = [bin_expression(table.c[cn], b) for cn, b in zip(projection, spec[1])]
+    s = sa.select(keys + [sa.func.count()]).select_from(table)
+    if where is not None:
+        s = s.where(where)
+    return s.group_by(*keys)
+
+def cells_collect(conn, sstmt, spec):
+    '''list of (key tuple, count) for the non-empty cells'''
+    return {'cells' : [(tuple(row[:-1]), int(row[-1]))
+                       for row in conn.execute(sstmt)]}
+
+aggregates = {'count' : {'select' : count_select,
+                         'collect' : count_collect},
+              'cells' : {'select' : cells_select,
+                         'collect' : cells_collect}}
+
+# exact aggregates are cached, keyed by data set, data version,
+# canonical predicate, projection and specification. Noise is added
+# later by the processors, so a cached count is never released as is.
+
+def canonical_selection(selection):
+    '''a hashable normal form of a DNF predicate
+
+       Order and repetition of descriptors within a conjunction and of
+       conjunctions within the disjunction do not change the predicate.'''
+    conjs = set((bool(neg), tuple(sorted(set(map(tuple, descs)))))
+                for (neg, descs) in (selection or []))
+    return tuple(sorted(conjs))
+
+def canonical_spec(spec):
+    '''an aggregate specification with lists made into tuples'''
+    if isinstance(spec, (list, tuple)):
+        return tuple(map(canonical_spec, spec))
+    return spec
+
+def aggregate_size(entries):
+    '''a rough estimate of the memory used by collected entries (bytes)'''
+    return 100 + sum(map(lambda (k, n) : 80 + 40 * len(k), entries.get('cells', [])))
+
+class AggregateCache:
+    '''a bounded LRU cache of exact aggregates
+
+       At most size entries using at most memory bytes (as estimated
+       by aggregate_size) are kept. Used from several worker threads.'''
+
+    def __init__(self, size = 256, memory = 64 * 2**20):
+        self.size = size
+        self.memory = memory
+        self.used = 0
+        self.hits = 0
+        self.misses = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.entries:
+                self.misses += 1
+                return None
+            self.hits += 1
+            value = self.entries.pop(key)
+            self.entries[key] = value # most recently used last
+            return value[0]
+
+    def put(self, key, entries):
+        nbytes = aggregate_size(entries)
+        if nbytes > self.memory:
+            return
+        with self.lock:
+            if key in self.entries:
+                self.used -= self.entries.pop(key)[1]
+            self.entries[key] = (entries, nbytes)
+            self.used += nbytes
+            while len(self.entries) > self.size or self.used > self.memory:
+                self.used -= self.entries.popitem(last = False)[1][1]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.used = 0
+
+    def report(self):
+        '''cache statistics as text'''
+        return ('aggregate cache: ' + str(self.hits) + ' hits, ' + str(self.misses) +
+                ' misses, ' + str(len(self.entries)) + ' entries, ' +
+                str(self.used) + ' bytes')
+
+aggregate_cache = None
+
+def init_aggregate_cache(size, memory):
+    '''set up the aggregate cache. No caching if size is 0.'''
+    global aggregate_cache
+    aggregate_cache = AggregateCache(size, memory) if size > 0 else None
+    return aggregate_cache
+
+def data_version(meta, conn, sname):
+    '''the version of data set sname, or None if versions are not kept'''
+    stable = meta.tables['datasets']
+    if 'version' not in stable.c:
+        return None
+    return conn.execute(sa.select([stable.c.version]).where(stable.c.name == sname)).scalar()
+
+# functions f(set, version, selection, projection, spec) that can
+# compute aggregate entries without querying the data table. They
+# return None if they cannot.
+aggregate_sources = []
+
+def collect_aggregate(backend, query, spec, sstmt):
+    '''the aggregate entries for the query, from the cache or an
+       aggregate source if possible'''
+    (set, selection, projection) = query
+    conn = get_connection(backend)
+    cache = aggregate_cache
+    version = None
+    if cache != None or aggregate_sources:
+        version = data_version(backend['schema'], conn, set)
+
+    def collect():
+        for source in aggregate_sources:
+            entries = source(set, version, selection, projection, spec)
+            if entries != None:
+                return entries
+        return aggregates[spec[0]]['collect'](conn, sstmt, spec)
+
+    if cache == None or version == None: # a re-import could not be noticed
+        return collect()
     try:
-        if projection:
-            what = map(lambda k: table.c[k], projection)
-        else :
-            what = [table]
-
-        if selection:
-            where = reduce(lambda x,y: x | y,
-                       map(conj, selection))
-            s = sa.select(what).where(where)
+        key = (set, version, canonical_selection(selection),
+               tuple(projection), canonical_spec(spec))
+        hash(key)
+    except TypeError: # unhashable values in the predicate
+        return collect()
+    entries = cache.get(key)
+    if entries == None:
+        entries = collect()
+        cache.put(key, entries)
+    return dict(entries)
+
+def make_select(meta, setd, selection, projection, aggregate = None):
+    '''create a sqlalchemy executable select expression'''
+
+    table = meta.tables[setd['name']]
+
+    try:
+        where = make_where(table, setd, selection)
+        if aggregate:
+            s = aggregates[aggregate[0]]['select'](table, setd, where,
+                                                   projection, aggregate)
         else:
+            if projection:
+                what = map(lambda k: table.c[k], projection)
+            else :
+                what = [table]
             s = sa.select(what)
+            if where is not None:
+                s = s.where(where)
 
     except Exception as e:
         raise Exception('malformed query: ' + str(e))
@@ -206,13 +425,66 @@ def get_data_iterator(conn, sstmt):
     for row in conn.execute(sstmt):
         yield tuple(row)
 
+batch_rows = 10000 # rows fetched at a time when making columns
+
+def get_data_columns(conn, sstmt, setd, projection, size = batch_rows):
+    '''the selected rows as a dict of column name -> numpy array
+
+       Categorical columns hold integer codes, indices into the list
+       of values given for the column in the returned labels dict.'''
+    attd = setd['attributes']
+    types = map(lambda cn : attd[cn]['type'], projection)
+    labels = dict((cn, sorted(attd[cn]['values'].keys()))
+                  for (cn, t) in zip(projection, types) if t == CATEGORICAL)
+    codes = dict((cn, dict((v, i) for (i, v) in enumerate(vals)))
+                 for (cn, vals) in labels.items())
+
+    def code(cn, v):
+        if v not in codes[cn]: # not in the metadata
+            codes[cn][v] = len(labels[cn])
+            labels[cn].append(v)
+        return codes[cn][v]
+
+    dtypes = {CATEGORICAL : np.int32, INTEGER : np.int64, FLOAT : np.float64}
+    parts = map(lambda cn : [], projection)
+    res = conn.execute(sstmt)
+    while True:
+        rows = res.fetchmany(size)
+        if not rows:
+            break
+        for (i, col) in enumerate(zip(*rows)):
+            (cn, t) = (projection[i], types[i])
+            if t == CATEGORICAL:
+                col = map(lambda v : code(cn, v), col)
+            parts[i].append(np.array(col, dtype = dtypes.get(t, object)))
+    columns = map(lambda (t, p) : np.concatenate(p) if p else np.zeros(0, dtype = dtypes.get(t, object)),
+                  zip(types, parts))
+    return {'columns' : dict(zip(projection, columns)), 'labels' : labels}
+
 def init_backend(database):
     '''initalize the backend'''
     engine = sa.create_engine(database)
     conn = engine.connect()
     (meta, sets) = get_meta(conn)
     data_meta = get_backend_metadata(conn)
-    return {'schema' : meta, 'meta' : data_meta, 'engine': engine, 'connection' : conn}
+    local = threading.local()
+    local.connection = conn
+    return {'schema' : meta, 'meta' : data_meta, 'engine': engine, 'connection' : conn,
+            'local' : local, 'query' : query_backend, 'version' : backend_version}
+
+def backend_version(backend, sname):
+    '''the current version of data set sname (see data_version)'''
+    return data_version(backend['schema'], get_connection(backend), sname)
+
+def get_connection(backend):
+    '''a connection for the calling thread
+
+    Connections cannot be shared between threads, so queries run by
+    worker threads each get their own.'''
+    local = backend['local']
+    if not hasattr(local, 'connection'):
+        local.connection = backend['engine'].connect()
+    return local.connection
 
 def reinit_backend(backend):
     conn = backend['connection']
@@ -223,8 +495,16 @@ def reinit_backend(backend):
     return backend
 
 
-def query_backend(backend, query):
-    '''query the backend for the data'''
+def query_backend(backend, query, aggregate = None, columns = False):
+    '''query the backend for the data
+
+    aggregate -- if given, a function f(setd, attributes) that returns
+                 an aggregate specification (see aggregates) or
+                 None. Aggregates are computed by the database and
+                 their entries replace the 'data' row iterator in
+                 the result.
+    columns   -- if True, the result holds 'columns' and 'labels'
+                 (see get_data_columns) instead of 'data'.'''
 
     (set, selection, projection) = query[:3]
 
@@ -233,10 +513,17 @@ def query_backend(backend, query):
 
     #    raise Exception('Query projection cannot be empty.')
     setd =  backend['meta']['datasets'][set]
-    s = make_select(backend['schema'],setd, selection, projection)
-    return {'data' : get_data_iterator(backend['connection'], s),
-            'setd' : setd,
-            'attributes': projection if projection else attrs }
+    spec = aggregate(setd, projection) if aggregate else None
+    s = make_select(backend['schema'],setd, selection, projection, spec)
+    result = {'setd' : setd,
+              'attributes': projection }
+    if spec:
+        result.update(collect_aggregate(backend, (set, selection, projection), spec, s))
+    elif columns:
+        result.update(get_data_columns(get_connection(backend), s, setd, projection))
+    else:
+        result['data'] = get_data_iterator(get_connection(backend), s)
+    return result
 
 def get_risk_meta(conn):
     '''get risk_db metadata'''
@@ -253,8 +540,66 @@ def init_risk_backend(database):
     engine = sa.create_engine(database)
     conn = engine.connect()
     meta = get_risk_meta(conn)
+    if 'totals' not in meta.tables: # database predates running totals
+        make_totals_table(meta, conn)
+    make_history_index(meta, conn)
     return {'schema' : meta, 'engine': engine, 'connection' : conn}
 
+def make_history_index(metadata, conn):
+    '''index the history by user if the database predates the index
+
+    make_risk_tables only creates the index along with the table.'''
+    htable = metadata.tables['history']
+    if not any([c.name for c in i.columns] == ['id'] for i in htable.indexes):
+        sa.Index('ix_history_id', htable.c.id).create(bind = conn)
+
+def make_totals_table(metadata, conn, doit=True):
+    '''create the table of per user risk expenditure totals
+
+    The totals are kept equal to the sum of the user's history rows so
+    that budget checks do not have to sum over the history. If the
+    table is created, it is filled from the history.'''
+    ttable = Table('totals', metadata,
+                   Column('id', None, ForeignKey('users.id'), primary_key=True),
+                   Column('spent', Float, default=0.0, nullable=False))
+    if doit and not conn.dialect.has_table(conn, 'totals'):
+        metadata.create_all(bind = conn, tables = [ttable])
+        spent = recompute_totals(conn, metadata.tables['users'],
+                                 metadata.tables['history'])
+        if spent:
+            conn.execute(ttable.insert(),
+                         [{'id' : k, 'spent' : v} for k, v in spent.items()])
+    return ttable
+
+def recompute_totals(conn, utable, htable, user=None):
+    '''dict of user id to the sum of the user's history'''
+    s = sa.select([utable.c.id])
+    h = sa.select([htable.c.id, sa.func.sum(htable.c.eps)]).group_by(htable.c.id)
+    if user != None:
+        s = s.where(utable.c.id == user)
+        h = h.where(htable.c.id == user)
+    sums = dict(conn.execute(h).fetchall())
+    return dict((k, float(sums.get(k) or 0.0)) for (k,) in conn.execute(s))
+
+def verify_totals(conn, utable, htable, ttable, user=None, repair=False):
+    '''list (id, stored, recomputed) for users whose total is wrong
+
+    If repair is True, the stored totals are corrected.'''
+    spent = recompute_totals(conn, utable, htable, user)
+    s = sa.select([ttable.c.id, ttable.c.spent])
+    if user != None:
+        s = s.where(ttable.c.id == user)
+    stored = dict(conn.execute(s).fetchall())
+    bad = [(k, stored.get(k), v) for k, v in sorted(spent.items())
+           if stored.get(k) == None or abs(stored[k] - v) > 1e-9 * max(1.0, abs(v))]
+    if repair:
+        for (k, old, v) in bad:
+            if old == None:
+                conn.execute(ttable.insert().values(id=k, spent=v))
+            else:
+                conn.execute(ttable.update().values(spent=v).where(ttable.c.id == k))
+    return bad
+
 def make_risk_tables(metadata, doit=True):
     '''create the metadata tables'''
 
@@ -264,18 +609,20 @@ def make_risk_tables(metadata, doit=True):
                    Column('tt', Float, default=10.0, nullable=False),
                    Column('qt', Float, default=3.0, nullable=False))    
     htable = Table('history', metadata,
-                   Column('id', None, ForeignKey('users.id')),
+                   Column('id', None, ForeignKey('users.id'), index=True),
                    Column('eps', Float, nullable=False),
                    Column('time', DateTime, server_default=sa.func.now(), nullable=False))
     tables = [utable, htable]
     if doit:
         metadata.create_all(tables = tables)
+    tables.append(make_totals_table(metadata, metadata.bind, doit))
     return tables
 
 
             
 if __name__ == "__main__":    
     import sys
+    assert(test_bins())
     #try:
     backend = init_backend('sqlite:////tmp/dpdqserver/warehouse.db')
         #except Exception as e:
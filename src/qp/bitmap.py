@@ -0,0 +1,189 @@
+# bitmap indexes. Row counts of predicates are computed with bitwise
+# operations on packed bitmaps and popcount.
+
+__all__ = ['BitmapIndex', 'build_bitmaps', 'save_bitmaps', 'init_bitmaps',
+           'bitmap_answer']
+
+import os
+from ast import literal_eval
+from bisect import bisect_left, bisect_right
+from logging import info, warning
+import numpy as np
+import sqlalchemy as sa
+
+import backend as be
+from backend import CATEGORICAL, INTEGER, FLOAT, data_version, get_connection
+
+# Bitmaps hold one bit per row, packed 8 to a byte (np.packbits).
+# Categorical attributes have one bitmap per value. Numeric attributes
+# are range encoded: bitmap j holds the rows with value < keys[j]. If
+# there are at most max_distinct distinct values, the keys are these
+# values and any comparison can be answered. Otherwise the keys are
+# max_distinct + 1 equally spaced edges from the lower to the upper
+# bound, widened to take in values outside the bounds of the metadata,
+# and only comparisons with an edge or a value outside the edges can
+# be.
+
+max_distinct = 256
+
+popcount = np.array(map(lambda i : bin(i).count('1'), range(256)), dtype=np.uint8)
+
+def count_bits(bits):
+    return int(popcount[bits].sum(dtype=np.int64))
+
+
+class BitmapIndex:
+    '''bitmaps over the rows of a data set
+
+       dims is a list of (name, kind, keys, offset), where kind is
+       'values', 'distinct' or 'edges', and the bitmaps of the attribute are rows
+       offset, offset + 1, ... of bits, one for each key.'''
+
+    def __init__(self, name, version, n, dims, bits):
+        self.name = name
+        self.version = version
+        self.n = n
+        self.dims = dict((d[0], d[1:]) for d in dims)
+        self.bits = bits
+        self.all = np.packbits(np.ones(n, dtype=bool))
+        self.none = np.zeros(len(self.all), dtype=np.uint8)
+
+    def not_(self, b):
+        return ~b & self.all # keep the padding bits clear
+
+    def literal(self, (a, o, v)):
+        '''the bitmap of rows with a o v, or None'''
+        (kind, keys, offset) = self.dims[a]
+        if kind == 'values':
+            b = self.bits[offset + keys.index(v)] if v in keys else self.none
+            return {'==' : lambda : b, '!=' : lambda : self.not_(b)}[o]()
+        v = float(v)
+        def below(j): # rows with value < keys[j], j in [0, len(keys)]
+            return self.all if j == len(keys) else self.bits[offset + j]
+        if kind == 'distinct':
+            lt = below(bisect_left(keys, v))
+            le = below(bisect_right(keys, v))
+        else: # edges: only < and >= at an edge, or outside the edges
+            (lo, hi) = keys[0], keys[-1]
+            if v < lo or v > hi:
+                lt = le = self.none if v < lo else self.all
+            elif v in keys and o in ['<', '>=']:
+                lt = le = below(keys.index(v))
+            else:
+                return None
+        return {'<' : lambda : lt,
+                '<=' : lambda : le,
+                '>' : lambda : self.not_(le),
+                '>=' : lambda : self.not_(lt),
+                '==' : lambda : le & self.not_(lt),
+                '!=' : lambda : self.not_(le & self.not_(lt))}[o]()
+
+    def select(self, selection):
+        '''the bitmap of rows satisfying the DNF predicate, or None'''
+        if not selection:
+            return self.all
+        res = self.none
+        for (neg, descs) in selection:
+            conj = self.all
+            for desc in descs:
+                b = self.literal(desc)
+                if b is None:
+                    return None
+                conj = conj & b
+            res = res | (self.not_(conj) if neg else conj)
+        return res
+
+    def count(self, selection):
+        '''the number of rows satisfying the predicate, or None'''
+        try:
+            if not all(map(lambda (a, o, v) : a in self.dims,
+                           sum(map(lambda c : list(c[1]), selection or []), []))):
+                return None
+            b = self.select(selection)
+            return None if b is None else count_bits(b)
+        except Exception as e:
+            warning('bitmaps ' + self.name + ': ' + str(e))
+            return None
+
+
+def build_bitmaps(backend, name, version):
+    '''build the bitmap index of data set name in one scan'''
+    setd = backend['meta']['datasets'][name]
+    attd = setd['attributes']
+    names = sorted(filter(lambda cn : attd[cn]['type'] in [CATEGORICAL, INTEGER, FLOAT], attd))
+    table = backend['schema'].tables[name]
+    rows = map(tuple, get_connection(backend).execute(sa.select(map(lambda cn : table.c[cn], names))))
+    colv = zip(*rows) if rows else [()] * len(names)
+    dims = []
+    bits = []
+    for (cn, col) in zip(names, colv):
+        if attd[cn]['type'] == CATEGORICAL:
+            keys = sorted(attd[cn]['values'].keys())
+            col = np.asarray(col, dtype=object)
+            dims.append((cn, 'values', keys, len(bits)))
+            bits.extend(map(lambda k : np.packbits(col == k), keys))
+            continue
+        col = np.asarray(col, dtype=float)
+        keys = sorted(set(col.tolist()))
+        kind = 'distinct'
+        if len(keys) > max_distinct:
+            (a, b) = (attd[cn]['bounds']['lower'], attd[cn]['bounds']['upper'])
+            (a, b) = (min(a, keys[0]), max(b, keys[-1]))
+            keys = list(np.linspace(a, b, max_distinct + 1))
+            kind = 'edges'
+        dims.append((cn, kind, map(float, keys), len(bits)))
+        bits.extend(map(lambda k : np.packbits(col < k), keys))
+    bits = np.array(bits, dtype=np.uint8).reshape(len(bits), (len(rows) + 7) // 8)
+    return BitmapIndex(name, version, len(rows), dims, bits)
+
+def bitmap_files(directory, base, name, version):
+    stem = os.path.join(directory, base + '.' + name + '.v' + str(version) + '.bitmap')
+    return (stem + '.npy', stem + '.meta')
+
+def save_bitmaps(directory, base, index):
+    (bfile, mfile) = bitmap_files(directory, base, index.name, index.version)
+    np.save(bfile, index.bits)
+    f = open(mfile, 'w')
+    f.write(repr((index.n, sorted((k,) + v for (k, v) in index.dims.items()))))
+    f.close()
+
+def load_bitmaps(directory, base, name, version):
+    (bfile, mfile) = bitmap_files(directory, base, name, version)
+    if not (os.path.exists(bfile) and os.path.exists(mfile)):
+        return None
+    (n, dims) = literal_eval(open(mfile).read())
+    return BitmapIndex(name, version, n, dims, np.load(bfile, mmap_mode = 'r'))
+
+indexes = {} # data set name -> BitmapIndex
+
+def init_bitmaps(backend, directory, base = 'dpdq'):
+    '''load the bitmap indexes made by dpdq_csv2db for the current
+       versions of the data sets'''
+    if not backend.has_key('schema'):
+        info('bitmap indexes are only used with sql databases')
+        return indexes
+    conn = get_connection(backend)
+    for name in backend['meta']['datasets']:
+        version = data_version(backend['schema'], conn, name)
+        try:
+            index = load_bitmaps(directory, base, name, version) if version != None else None
+        except Exception as e:
+            warning('Could not load bitmaps for ' + name + ': ' + str(e))
+            index = None
+        if index == None:
+            info('no bitmaps for ' + name)
+            continue
+        indexes[name] = index
+        info('bitmaps for ' + name + ': ' + str(len(index.bits)))
+    if bitmap_answer not in be.aggregate_sources:
+        be.aggregate_sources.append(bitmap_answer)
+    return indexes
+
+def bitmap_answer(name, version, selection, projection, spec):
+    '''aggregate source (see backend.aggregate_sources) counting with
+       the bitmap indexes'''
+    index = indexes.get(name)
+    if spec[0] != 'count' or index == None or version == None or index.version != version:
+        return None
+    count = index.count(selection)
+    return None if count == None else {'count' : count}
@@ -0,0 +1,166 @@
+# columnar backend. Data sets are stored as one .npy file per column,
+# and metadata in a sidecar file, in a folder given by a
+# columnar:///path url.
+
+__all__ = ['is_columnar', 'init_columnar', 'query_columnar', 'write_columnar']
+
+import os
+import shutil
+from ast import literal_eval
+import numpy as np
+
+from backend import operators, mk_cmp, CATEGORICAL, INTEGER, FLOAT
+from histogram import column_index
+from cube import group_rows
+
+# The store folder holds the file 'datasets.meta' and a folder for each
+# data set with a file <column>.npy for each column. The meta file is
+# a python literal: a dict from data set name to (column names, set
+# metadata), where the set metadata is as backend.get_set_dict
+# returns. Categorical columns are stored as small integer codes,
+# indices into the sorted values of the attribute.
+
+scheme = 'columnar://'
+meta_file = 'datasets.meta'
+
+def is_columnar(database):
+    return database != None and database.startswith(scheme)
+
+def store_path(database):
+    return database[len(scheme):]
+
+def read_meta(path):
+    fname = os.path.join(path, meta_file)
+    if not os.path.exists(fname):
+        return {}
+    return literal_eval(open(fname).read())
+
+def category_values(setd, name):
+    return sorted(setd['attributes'][name]['values'].keys())
+
+def init_columnar(database):
+    '''initialize the columnar backend'''
+    path = store_path(database)
+    if not os.path.isdir(path):
+        raise Exception('No columnar store in ' + path)
+    stored = read_meta(path)
+    columns = {}
+    for (sname, (names, setd)) in stored.items():
+        columns[sname] = dict((cn, np.load(os.path.join(path, sname, cn + '.npy'), mmap_mode = 'r'))
+                              for cn in names)
+    return {'meta' : {'operators' : operators,
+                      'datasets' : dict((k, v[1]) for (k, v) in stored.items())},
+            'names' : dict((k, v[0]) for (k, v) in stored.items()),
+            'columns' : columns,
+            'path' : path,
+            'query' : query_columnar,
+            'version' : columnar_version}
+
+def columnar_version(backend, sname):
+    '''the current version of data set sname, read from the meta file
+       so that a replaced data set is noticed'''
+    stored = read_meta(backend['path'])
+    return stored[sname][1].get('version') if sname in stored else None
+
+def make_mask(columns, setd, selection, n):
+    '''evaluate a DNF predicate over the columns (or None)'''
+
+    def desc((a, o, v)):
+        typ = setd['attributes'][a]['type']
+        col = columns[a]
+        cmp = mk_cmp(typ, o)
+        if typ == CATEGORICAL: # compare codes
+            vals = category_values(setd, a)
+            if v not in vals: # no row has the value
+                return cmp(np.zeros(n, dtype=np.int8), 1)
+            return cmp(col, vals.index(v))
+        return cmp(col, v)
+
+    def conj((neg, descs)):
+        c = reduce(lambda x, y : x & y, map(desc, descs))
+        return ~c if neg else c
+
+    if not selection:
+        return None
+    return reduce(lambda x, y : x | y, map(conj, selection))
+
+def decoded(setd, name, col):
+    '''column values, with categorical codes replaced by the values'''
+    if setd['attributes'][name]['type'] == CATEGORICAL:
+        return np.array(category_values(setd, name), dtype=object)[col]
+    return col
+
+def query_columnar(backend, query, aggregate = None, columns = False):
+    '''query the columnar backend (see backend.query_backend)'''
+    (sname, selection, projection) = query[:3]
+    setd = backend['meta']['datasets'][sname]
+    stored = backend['columns'][sname]
+    n = setd['size']
+    if projection == []:
+        projection = backend['names'][sname]
+    try:
+        mask = make_mask(stored, setd, selection, n)
+        spec = aggregate(setd, projection) if aggregate else None
+        pick = lambda col : col if mask is None else col[mask]
+        result = {'setd' : setd,
+                  'attributes' : projection}
+        if spec and spec[0] == 'count':
+            result['count'] = n if mask is None else int(mask.sum())
+        elif spec and spec[0] == 'cells':
+            keys = map(lambda (cn, b) : pick(stored[cn]) if b == None else
+                       column_index(pick(stored[cn]), None, b), zip(projection, spec[1]))
+            m = n if mask is None else int(mask.sum())
+            (keys, counts) = group_rows(np.column_stack(keys).astype(np.int64) if keys else
+                                        np.zeros((m, 0), dtype=np.int64),
+                                        np.ones(m, dtype=np.int64))
+            labels = map(lambda (cn, b) : category_values(setd, cn) if b == None else None,
+                         zip(projection, spec[1]))
+            result['cells'] = [(tuple(v if lab == None else lab[v]
+                                      for (v, lab) in zip(map(int, row), labels)), int(c))
+                               for (row, c) in zip(keys, counts)]
+        elif spec:
+            raise Exception('unknown aggregate ' + str(spec[0]))
+        elif columns: # the stored codes are handed over as they are
+            result['columns'] = dict((cn, np.asarray(pick(stored[cn]))) for cn in projection)
+            result['labels'] = dict((cn, category_values(setd, cn)) for cn in projection
+                                    if setd['attributes'][cn]['type'] == CATEGORICAL)
+        else:
+            cols = map(lambda cn : decoded(setd, cn, pick(stored[cn])), projection)
+            result['data'] = (tuple(row) for row in zip(*map(lambda c : c.tolist(), cols)))
+    except Exception as e:
+        raise Exception('malformed query: ' + str(e))
+    return result
+
+def write_columnar(path, sname, names, setd, rows):
+    '''store data set sname with columns names from the row tuples
+
+       An existing data set sname is replaced.'''
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    stored = read_meta(path)
+    folder = os.path.join(path, sname)
+    if os.path.isdir(folder):
+        shutil.rmtree(folder)
+    os.makedirs(folder)
+    colv = zip(*rows) if rows else [()] * len(names)
+    for (cn, col) in zip(names, colv):
+        typ = setd['attributes'][cn]['type']
+        if typ == CATEGORICAL:
+            vals = category_values(setd, cn)
+            codes = dict((v, i) for (i, v) in enumerate(vals))
+            dtype = np.int8 if len(vals) < 2**7 else np.int16 if len(vals) < 2**15 else np.int32
+            arr = np.array(map(lambda v : codes[v if isinstance(v, basestring) else str(v)], col),
+                           dtype = dtype)
+        elif typ == INTEGER:
+            arr = np.array(col, dtype = np.int64)
+        elif typ == FLOAT:
+            arr = np.array(col, dtype = np.float64)
+        else:
+            raise Exception('cannot store column ' + cn + ' of type ' + str(typ))
+        np.save(os.path.join(folder, cn + '.npy'), arr)
+    stored[sname] = (names, setd)
+    tmp = os.path.join(path, meta_file + '.tmp')
+    f = open(tmp, 'w')
+    f.write(repr(stored))
+    f.close()
+    os.rename(tmp, os.path.join(path, meta_file))
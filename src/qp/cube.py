@@ -0,0 +1,280 @@
+# materialized contingency cubes. Counts and histogram cells of queries
+# that align with attribute values and bins are computed from the cube
+# instead of the table.
+
+__all__ = ['Cube', 'build_cube', 'init_cubes', 'cube_answer', 'cube_location']
+
+import os
+from ast import literal_eval
+from fractions import gcd
+from logging import info, warning
+import numpy as np
+import sqlalchemy as sa
+
+import backend as be
+from backend import CATEGORICAL, INTEGER, FLOAT, data_version, get_connection
+from histogram import histogram_nbin, column_index
+
+# A cube is kept sparse: one row of per attribute value indices for
+# each non-empty cell, followed by the cell count. Numeric attributes
+# are cut into nfine equal width bins, where nfine is a multiple of the
+# bin numbers histograms can ask for, so that each histogram bin is a
+# union of cube bins. Values outside the bounds of the metadata are
+# counted in the first or last bin, as histograms do, so these bins
+# cannot decide predicates on such values.
+
+nbin_mins = range(1, 5) # the values the Histogram MinBins parameter can take
+max_fine = 4096 # max number of cube bins for a numeric attribute
+
+cubes = {} # data set name -> Cube
+
+def fine_bins(size, dim):
+    '''(nfine, histogram bin numbers nfine is a multiple of)'''
+    ks = sorted(set(histogram_nbin(size, d, m)
+                    for d in range(1, dim + 1) for m in nbin_mins))
+    nfine = 1
+    for k in ks:
+        l = nfine * k / gcd(nfine, k)
+        if l <= max_fine:
+            nfine = l
+    return (nfine, filter(lambda k : nfine % k == 0, ks))
+
+def bin_width(a, b, nbin):
+    '''the bin width used by histogram.column_bins'''
+    extra = float(b-a)/1000
+    return float((b+extra)-a)/nbin
+
+def group_rows(keys, counts):
+    '''distinct rows of the matrix keys and the summed counts'''
+    if len(keys) == 0:
+        return (keys, counts)
+    order = np.lexsort(keys.T[::-1])
+    keys = keys[order]
+    starts = np.concatenate(([0], np.nonzero(np.any(keys[1:] != keys[:-1], axis=1))[0] + 1))
+    return (keys[starts], np.add.reduceat(counts[order], starts))
+
+
+class Cube:
+    '''counts of the non-empty cells of a data set
+
+       dims is a list of (name, values, bounds) where values is the
+       list of values of a categorical attribute and bounds is None,
+       or values is None and bounds is (a, b, nfine, ks, (below, above))
+       for a numeric attribute, ks being the histogram bin numbers that
+       can be computed from the cube, and below (above) telling if
+       there are values below a (above b).'''
+
+    def __init__(self, name, version, dims, cells):
+        self.name = name
+        self.version = version
+        self.dims = dims
+        self.index = dict((d[0], i) for i, d in enumerate(dims))
+        self.cells = cells # rows of indices and a count
+
+    def column(self, name):
+        return self.cells[:, self.index[name]]
+
+    def descriptor(self, (a, o, v)):
+        '''cells matching a op v as a boolean array, or None if
+           the cells do not decide it'''
+        (name, values, bounds) = self.dims[self.index[a]]
+        col = self.column(a)
+        if values != None:
+            hit = (col == values.index(v)) if v in values else np.zeros(len(col), dtype=bool)
+            return {'==' : hit, '!=' : ~hit}.get(o)
+        (lo_b, hi_b, nfine, ks, (below, above)) = bounds
+        w = bin_width(lo_b, hi_b, nfine)
+        tol = 1e-9 * max(1.0, abs(w * nfine))
+        lo = lo_b + col * w - tol # the bin values are in [lo, hi)
+        hi = lo_b + (col + 1) * w + tol
+        if below:
+            lo = np.where(col == 0, -np.inf, lo)
+        if above:
+            hi = np.where(col == nfine - 1, np.inf, hi)
+        v = float(v)
+        (true, false) = {'<' : (v >= hi, v <= lo),
+                         '<=' : (v >= hi, v < lo),
+                         '>' : (v < lo, v >= hi),
+                         '>=' : (v <= lo, v >= hi),
+                         '==' : (np.zeros(len(col), dtype=bool), (v < lo) | (v >= hi)),
+                         '!=' : ((v < lo) | (v >= hi), np.zeros(len(col), dtype=bool))}[o]
+        if not np.all(true | false):
+            return None
+        return true
+
+    def select(self, selection):
+        '''cells matching the DNF predicate, or None'''
+        if not selection:
+            return np.ones(len(self.cells), dtype=bool)
+        mask = np.zeros(len(self.cells), dtype=bool)
+        for (neg, descs) in selection:
+            conj = np.ones(len(self.cells), dtype=bool)
+            for desc in descs:
+                m = self.descriptor(desc)
+                if m is None:
+                    return None
+                conj &= m
+            mask |= ~conj if neg else conj
+        return mask
+
+    def key_column(self, name, spec):
+        '''backend cell keys for the column, or None'''
+        (dname, values, bounds) = self.dims[self.index[name]]
+        col = self.column(name)
+        if spec == None:
+            return None if values == None else col
+        (a, b, w, nbin) = spec
+        if values != None or (a, b) != bounds[:2] or nbin not in bounds[3]:
+            return None
+        return col * nbin // bounds[2]
+
+    def answer(self, selection, projection, spec):
+        '''the aggregate entries (see backend.aggregates), or None if
+           the query does not align with the cube'''
+        try:
+            names = set(map(lambda (a, o, v) : a, sum(map(lambda c : list(c[1]), selection or []), [])))
+            if spec[0] == 'cells':
+                names.update(projection)
+            elif spec[0] != 'count':
+                return None
+            if not names <= set(self.index):
+                return None
+            mask = self.select(selection)
+            if mask is None:
+                return None
+            counts = self.cells[mask, -1]
+            if spec[0] == 'count':
+                return {'count' : int(counts.sum())}
+            cols = map(lambda (cn, s) : self.key_column(cn, s), zip(projection, spec[1]))
+            if any(map(lambda c : c is None, cols)):
+                return None
+            keys = np.column_stack(cols)[mask] if cols else np.zeros((len(counts), 0), dtype=np.int64)
+            (keys, counts) = group_rows(keys, counts)
+            label = map(lambda (cn, s) : self.dims[self.index[cn]][1] if s == None else None,
+                        zip(projection, spec[1]))
+            return {'cells' : [(tuple(v if lab == None else lab[v]
+                                      for (v, lab) in zip(map(int, row), label)), int(n))
+                               for (row, n) in zip(keys, counts) if n > 0]}
+        except Exception as e:
+            warning('cube ' + self.name + ': ' + str(e))
+            return None
+
+
+def build_cube(backend, name, version, size = be.batch_rows):
+    '''count the cells of data set name in one scan
+
+       Rows are read size at a time, and the cells of each batch are
+       added to the counts, so that only the non-empty cells are held.'''
+    setd = backend['meta']['datasets'][name]
+    attd = setd['attributes']
+    names = sorted(filter(lambda cn : attd[cn]['type'] in [CATEGORICAL, INTEGER, FLOAT], attd))
+    (nfine, ks) = fine_bins(setd['size'], len(names))
+    dims = []
+    for cn in names:
+        if attd[cn]['type'] == CATEGORICAL:
+            dims.append((cn, sorted(attd[cn]['values'].keys()), None))
+        else:
+            (a, b) = (attd[cn]['bounds']['lower'], attd[cn]['bounds']['upper'])
+            dims.append((cn, None, (a, b, nfine, ks, (False, False))))
+    table = backend['schema'].tables[name]
+    res = get_connection(backend).execute(sa.select(map(lambda cn : table.c[cn], names)))
+    cells = np.zeros((0, len(names) + 1), dtype=np.int64)
+    while True:
+        rows = res.fetchmany(size)
+        if not rows:
+            break
+        colv = zip(*rows) if names else []
+        indices = []
+        for (i, (cn, col)) in enumerate(zip(names, colv)):
+            (cn, values, bounds) = dims[i]
+            if values != None:
+                indices.append(column_index(col, values, None))
+                continue
+            (a, b, nfine, agree, (below, above)) = bounds
+            x = np.asarray(col, dtype=float)
+            outside = (below or bool(np.any(x < a)), above or bool(np.any(x > b)))
+            fine = column_index(x, None, (a, b, bin_width(a, b, nfine), nfine))
+            # keep only bin numbers for which the cube bins agree with the histogram's
+            agree = filter(lambda k : np.array_equal(fine * k // nfine,
+                                                     column_index(x, None, (a, b, bin_width(a, b, k), k))),
+                           agree)
+            dims[i] = (cn, None, (a, b, nfine, agree, outside))
+            indices.append(fine)
+        keys = np.column_stack(indices) if indices else np.zeros((len(rows), 0), dtype=np.int64)
+        keys = np.concatenate((cells[:, :-1], keys.astype(np.int64)))
+        counts = np.concatenate((cells[:, -1], np.ones(len(rows), dtype=np.int64)))
+        (keys, counts) = group_rows(keys, counts)
+        cells = np.column_stack((keys, counts))
+    for (cn, values, bounds) in dims:
+        if bounds != None and any(bounds[4]):
+            warning('cube ' + name + ': values of ' + cn + ' outside the bounds')
+    return Cube(name, version, dims, cells)
+
+def cube_files(directory, base, name, version):
+    stem = os.path.join(directory, base + '.' + name + '.v' + str(version) + '.cube')
+    return (stem + '.npy', stem + '.meta')
+
+def load_cube(directory, base, name, version):
+    (cfile, mfile) = cube_files(directory, base, name, version)
+    if not (os.path.exists(cfile) and os.path.exists(mfile)):
+        return None
+    dims = literal_eval(open(mfile).read())
+    if any(d[2] != None and len(d[2]) != 5 for d in dims): # made before out of bounds values were noted
+        return None
+    return Cube(name, version, dims, np.load(cfile, mmap_mode = 'r'))
+
+def save_cube(directory, base, cube):
+    (cfile, mfile) = cube_files(directory, base, cube.name, cube.version)
+    np.save(cfile, cube.cells)
+    f = open(mfile, 'w')
+    f.write(repr(cube.dims))
+    f.close()
+
+def cube_location(database, directory = None):
+    '''(directory, file name prefix) for the cubes and bitmap
+       indexes of a database
+
+       By default, these are kept next to the file of a sqlite
+       database, and in the current directory for others.'''
+    url = sa.engine.url.make_url(database)
+    if url.drivername.startswith('sqlite') and url.database:
+        path = os.path.abspath(url.database)
+        return (directory or os.path.dirname(path),
+                os.path.splitext(os.path.basename(path))[0])
+    return (directory or '.', url.database or 'dpdq')
+
+def init_cubes(backend, directory, base = 'dpdq'):
+    '''load, or build and save, the cubes of all data sets
+
+       Data sets without a version are skipped, as a replaced data
+       set could not be told from the one the cube was built from.'''
+    if not backend.has_key('schema'):
+        info('cubes are only made for sql databases')
+        return cubes
+    conn = get_connection(backend)
+    for name in backend['meta']['datasets']:
+        version = data_version(backend['schema'], conn, name)
+        if version == None:
+            info('no cube for ' + name + ': the data set has no version')
+            continue
+        try:
+            cube = load_cube(directory, base, name, version)
+            if cube == None:
+                print 'building cube for', name
+                cube = build_cube(backend, name, version)
+                save_cube(directory, base, cube)
+                cube = load_cube(directory, base, name, version)
+            cubes[name] = cube
+            info('cube for ' + name + ': ' + str(len(cube.cells)) + ' cells')
+        except Exception as e:
+            warning('Could not make cube for ' + name + ': ' + str(e))
+    if cube_answer not in be.aggregate_sources:
+        be.aggregate_sources.append(cube_answer)
+    return cubes
+
+def cube_answer(name, version, selection, projection, spec):
+    '''aggregate source (see backend.aggregate_sources) using the cubes'''
+    cube = cubes.get(name)
+    if cube == None or version == None or cube.version != version:
+        return None
+    return cube.answer(selection, projection, spec)
@@ -29,25 +29,181 @@
 #
 ################################################################################
 
-__all__ = ['rlaplace', 'plaplace']
+__all__ = ['rlaplace', 'rlaplace_n', 'rlaplace_tail_n', 'rgeometric_n', 'rbinom',
+           'plaplace', 'rpowerexp', 'set_generator', 'generator']
 
-from random import uniform
-from math import log, exp
-from numpy.random import binomial
+from random import uniform, random
+from math import log, exp, floor, expm1, log1p
+from bisect import bisect_right
+import numpy as np
 
-def rlaplace(scale, location = 0, r = 0):
+#### The batched samplers take a generator rng, an object with the
+#### methods of numpy.random.RandomState (uniform, binomial,
+#### geometric), e.g., RandomState(seed) for reproducible runs. If rng
+#### is None, the generator set with set_generator is used, and
+#### numpy.random if none is set.
+
+default_rng = None # the generator used when none is given
+
+def set_generator(g):
+    '''use generator g (or numpy.random if None) when none is given'''
+    global default_rng
+    default_rng = g
+
+def generator(rng = None):
+    return rng if rng != None else default_rng if default_rng != None else np.random
+
+def runif(rng = None):
+    '''a uniform deviate in [0, 1), from random unless a generator is given or set'''
+    if rng == None and default_rng == None:
+        return random()
+    return float(generator(rng).random_sample())
+
+def rlaplace(scale, location = 0, r = 0, rng = None):
     '''genrate a random deviate from Laplace(location, scale)'''
     assert(scale > 0)
-    r = uniform(r, 1)
+    if rng == None and default_rng == None:
+        r = uniform(r, 1)
+    else:
+        r = generator(rng).uniform(r, 1)
     signr = 1 if r >= 0.5 else -1    
     rr = r if r < 0.5 else 1 - r
     return location - signr * scale * log(2 * rr)
 
+def rlaplace_n(n, scale, location = 0, r = 0, rng = None):
+    '''n deviates from Laplace(location, scale) as a numpy array
+
+       location can be an array of length n. The deviates are drawn
+       by inversion from uniforms in [r, 1), or by the generator's
+       laplace if r is 0.'''
+    assert(scale > 0)
+    if r == 0:
+        return generator(rng).laplace(location, scale, n)
+    r = generator(rng).uniform(r, 1, n)
+    signr = np.where(r >= 0.5, 1, -1)
+    rr = np.where(r < 0.5, r, 1 - r)
+    return location - signr * scale * np.log(2 * rr)
+
+def rlaplace_tail_n(n, scale, tau, rng = None):
+    '''n deviates from Laplace(0, scale) conditioned on being at least tau'''
+    return rlaplace_n(n, scale, 0, plaplace(tau, scale = scale), rng)
+
+def rgeometric_n(n, scale, location = 0, rng = None):
+    '''n deviates from the two sided geometric distribution
+
+       P(location + k) is proportional to exp(-|k|/scale), the integer
+       valued counterpart of Laplace(location, scale). A deviate is the
+       difference of two geometric deviates.'''
+    assert(scale > 0)
+    g = generator(rng)
+    p = -expm1(-1.0/scale)
+    return location + g.geometric(p, n) - g.geometric(p, n)
+
 def plaplace(q, location = 0, scale = 1):
     '''quantile function'''
     assert(scale > 0)
     zedd = float(q - location)/scale
     return  0.5 * exp(zedd) if q < location else 1 - 0.5 * exp(-zedd)
 
-def rbinom(n, p):
-    return binomial(n, p)
+def rbinom(n, p, size = None, rng = None):
+    '''Binomial(n, p) deviates, an array of them if size is given'''
+    return generator(rng).binomial(n, p, size)
+
+
+#### Sampling r in {0, ..., size - 1} with P(r) proportional to
+#### exp(-cp * (r - count)**ap) for r >= count and
+#### exp(-cn * (count - r)**an) for r < count without visiting
+#### every r. Each side is a non increasing function f(k) of the
+#### distance k to count over a range [lo, hi] of k.
+
+def log_geometric(lo, hi, c):
+    '''log of sum(exp(-c * k) for k in [lo, hi])'''
+    n = hi - lo + 1
+    if n <= 0:
+        return float('-inf')
+    if c == 0:
+        return log(n)
+    return -c * lo + log(-expm1(-c * n)) - log(-expm1(-c))
+
+def rgeometric(lo, hi, c):
+    '''k in [lo, hi] with P(k) proportional to exp(-c * k)'''
+    n = hi - lo + 1
+    u = runif()
+    if c == 0:
+        return lo + min(int(u * n), n - 1)
+    return lo + min(int(floor(log1p(u * expm1(-c * n)) / -c)), n - 1)
+
+def dyadic_blocks(lo, hi, c, a):
+    '''[lo, hi] split into blocks of length 1, 2, 4, ...
+
+       with the log of the block length times f at the block start'''
+    blocks = []
+    (s, l) = (lo, 1)
+    while s <= hi:
+        e = min(s + l - 1, hi)
+        blocks.append((s, e, log(e - s + 1) - c * pow(s, a)))
+        (s, l) = (e + 1, 2 * l)
+    return blocks
+
+def rpowerexp(count, size, cp, ap, cn, an):
+    '''sample from the exponential mechanism of Tuned_Count
+
+       For ap == an == 1 the sides are geometric and sampled by
+       inversion. Otherwise rejection sampling from the envelope that
+       is constant on dyadic blocks is used. As f is non increasing,
+       the envelope mass of a block is at most twice the mass of f on
+       the previous block, so at least a quarter of the proposals are
+       accepted whatever the size.'''
+    sides = [(0, size - 1 - count, cp, ap, 1),             # r = count + k
+             (max(1, count - size + 1), count, cn, an, -1)] # r = count - k
+    sides = filter(lambda (lo, hi, c, a, sign) : lo <= hi, sides)
+    if ap == 1 and an == 1:
+        logz = map(lambda (lo, hi, c, a, sign) : log_geometric(lo, hi, c), sides)
+        m = max(logz)
+        z = map(lambda l : exp(l - m), logz)
+        (lo, hi, c, a, sign) = sides[0] if runif() * sum(z) < z[0] else sides[-1]
+        return count + sign * rgeometric(lo, hi, c)
+
+    blocks = []
+    for (lo, hi, c, a, sign) in sides:
+        blocks += map(lambda (s, e, w) : (s, e, w, c, a, sign), dyadic_blocks(lo, hi, c, a))
+    m = max(map(lambda b : b[2], blocks))
+    cum = []
+    t = 0
+    for b in blocks:
+        t += exp(b[2] - m)
+        cum.append(t)
+    while True:
+        (s, e, w, c, a, sign) = blocks[min(bisect_right(cum, runif() * t), len(blocks) - 1)]
+        k = s + min(int(runif() * (e - s + 1)), e - s)
+        if runif() < exp(-c * (pow(k, a) - pow(s, a))):
+            return count + sign * k
+
+
+if __name__ == "__main__":
+    import sys
+    from time import time
+
+    def bench(name, f, n):
+        t = time()
+        f(n)
+        t = time() - t
+        print '%-32s %10d %8.3fs %8.3f us/deviate' % (name, n, t, 1e6 * t / n)
+
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    g = np.random.RandomState(42)
+    counts = np.arange(n) % 100
+    print 'scalar and batched samplers, %d deviates' % n
+    bench('rlaplace', lambda n : [rlaplace(2.0, c) for c in counts.tolist()], n)
+    bench('rlaplace_n', lambda n : rlaplace_n(n, 2.0, counts, rng = g), n)
+    bench('rlaplace(r = plb)', lambda n : [rlaplace(2.0, 0, plaplace(5, scale = 2.0))
+                                           for i in xrange(n)], n)
+    bench('rlaplace_tail_n', lambda n : rlaplace_tail_n(n, 2.0, 5, rng = g), n)
+    bench('rbinom', lambda n : [rbinom(100, 0.1) for i in xrange(n)], n)
+    bench('rbinom(size = n)', lambda n : rbinom(100, 0.1, n, rng = g), n)
+    bench('rgeometric_n', lambda n : rgeometric_n(n, 2.0, counts, rng = g), n)
+
+    # the same generator state gives the same deviates
+    assert(np.array_equal(rlaplace_n(10, 1.0, rng = np.random.RandomState(1)),
+                          rlaplace_n(10, 1.0, rng = np.random.RandomState(1))))
+    assert(np.all(rlaplace_tail_n(1000, 2.0, 5, rng = g) >= 5))
@@ -37,16 +37,17 @@
 #
 ################################################################################
 
-from backend import init_backend, query_backend
+from backend import init_backend
+from columnar import is_columnar, init_columnar
 
-def init_frontend(database, processors, reinit=False):
+def init_frontend(database, processors, reinit=False, max_cells=None):
     if len(processors) == 0:
         raise Exception('Failed to initialize frontend: no processors given.')
     try: 
         if reinit:
             backend = reinit_backend(backend)
         else:
-            backend = init_backend(database)            
+            backend = (init_columnar if is_columnar(database) else init_backend)(database)
 
     except Exception as e:
         raise Exception('Could not initialize backend: ' + str(e))
@@ -58,10 +59,15 @@ def init_frontend(database, processors, reinit=False):
     meta = dict(backend['meta'])
     meta['processors'] = pdict
     
-    return {'backend' : backend, 'processors' : processors, 'meta' : meta}
+    return {'backend' : backend, 'processors' : processors, 'meta' : meta,
+            'max_cells' : max_cells}
 
 
-def handle_query(frontend, eps, query):
+def prepare_query(frontend, eps, query):
+    '''check and edit a data query
+
+       Returns (proc, parms, ddesc, aggregate) for fetch_query and
+       process_query.'''
     if eps <= 0:
         raise Exception('Privacy risk must be positive.')
     
@@ -85,23 +91,138 @@ def handle_query(frontend, eps, query):
 
     try:
         if proc.has_key('query_edit'):
-            parms += [('orig_query', {'predicate' :sel, 'attributes' : pro})]
+            parms = list(parms) + [('orig_query', {'predicate' :sel, 'attributes' : pro})]
             (sel, pro) = proc['query_edit'](sel, pro)
             ddesc = (dname, sel, pro)
     except Exception as e:
         raise Exception('Query edit failed: ' + str(e))
     
+    # let the processor ask the backend for an aggregate instead of rows
+    aggregate = None
+    if proc.has_key('aggregate'):
+        aggregate = lambda setd, attributes : proc['aggregate'](parms, setd, attributes)
+
+    return (proc, parms, ddesc, aggregate)
+
+def fetch_query(frontend, prepared):
+    '''get the data (or aggregate) for a prepared query from the backend'''
+    (proc, parms, ddesc, aggregate) = prepared
     try:
-        res = query_backend(frontend['backend'], ddesc)
+        backend = frontend['backend']
+        return backend['query'](backend, ddesc, aggregate, proc.get('input') == 'columns')
     except Exception as e:
         raise Exception('Data query failed: ' + str(e))
+
+def prefetch_query(frontend, prepared):
+    '''fetch_query, reading all rows so that the scan is done now'''
+    res = fetch_query(frontend, prepared)
+    if res.has_key('data'):
+        try:
+            res['data'] = list(res['data'])
+        except Exception as e:
+            raise Exception('Data query failed: ' + str(e))
+    return res
+
+def process_query(prepared, eps, res):
+    '''compute the response to a prepared query from the fetched data'''
+    (proc, parms, ddesc, aggregate) = prepared
     try:
-        pres = proc['f'](eps, parms, res)
+        return proc['f'](eps, parms, res)
     except Exception as e:
         raise Exception('Information processing failed: ' + str(e))
-    return pres
 
-    
-        
-    
-    
+def estimate_query(frontend, eps, prepared):
+    '''the cost of a prepared query, from the metadata alone
+
+       Returns a dict with the data set size 'rows', updated with the
+       dict the processor's 'estimate' returns.'''
+    (proc, parms, ddesc, aggregate) = prepared
+    (dname, sel, pro) = ddesc
+    backend = frontend['backend']
+    setd = backend['meta']['datasets'][dname]
+    estimate = {'rows' : setd['size']}
+    if proc.has_key('estimate'):
+        if pro == []:
+            pro = attribute_names(backend, dname)
+        try:
+            estimate.update(proc['estimate'](eps, parms, setd, pro))
+        except Exception as e:
+            raise Exception('Estimate failed: ' + str(e))
+    return estimate
+
+def check_estimate(frontend, estimate):
+    '''raise an exception if the query is expected to be too large'''
+    if not estimate.has_key('cells'):
+        return
+    limits = filter(lambda l : l != None, [estimate.get('limit'), frontend.get('max_cells')])
+    if limits and estimate['cells'][0] > min(limits):
+        raise Exception('Query too large: expected at least ' + str(int(round(estimate['cells'][0]))) +
+                        ' cells, the limit is ' + str(min(limits)) + '.')
+
+def preflight(frontend, eps, query):
+    '''prepare a query and reject it if it is expected to be too large
+
+       Returns (prepared, estimate).'''
+    prepared = prepare_query(frontend, eps, query)
+    estimate = estimate_query(frontend, eps, prepared)
+    check_estimate(frontend, estimate)
+    return (prepared, estimate)
+
+def handle_query(frontend, eps, query):
+    prepared = preflight(frontend, eps, query)[0]
+    return process_query(prepared, eps, fetch_query(frontend, prepared))
+
+
+#### batches of queries. Queries that need the same data (same data
+#### set description and aggregate) share one backend query.
+
+def attribute_names(backend, dname):
+    '''the attributes of data set dname, in table order'''
+    if backend.has_key('names'): # columnar
+        return backend['names'][dname]
+    return map(lambda col : col.name, backend['schema'].tables[dname].c)
+
+def scan_key(frontend, prepared):
+    '''queries with equal keys can share the backend query'''
+    (proc, parms, ddesc, aggregate) = prepared
+    (dname, sel, pro) = ddesc
+    if pro == []:
+        pro = attribute_names(frontend['backend'], dname)
+    spec = None
+    if aggregate:
+        spec = aggregate(frontend['backend']['meta']['datasets'][dname], pro)
+    return repr((ddesc, spec, proc.get('input')))
+
+def group_queries(frontend, queries):
+    '''prepare a list of (eps, query) and group them by scan_key
+
+       Returns a list of groups, each a list of (position, eps, prepared).'''
+    groups = {}
+    order = []
+    for (i, (eps, query)) in enumerate(queries):
+        prepared = preflight(frontend, eps, query)[0]
+        key = scan_key(frontend, prepared)
+        if not groups.has_key(key):
+            groups[key] = []
+            order.append(key)
+        groups[key].append((i, eps, prepared))
+    return map(lambda k : groups[k], order)
+
+def handle_group(frontend, group):
+    '''run a group of queries over one backend query
+
+       Returns a list of (position, ok, response or error message).'''
+    res = fetch_query(frontend, group[0][2])
+    rows = None
+    if res.has_key('data'):
+        rows = list(res['data'])
+    out = []
+    for (i, eps, prepared) in group:
+        r = dict(res)
+        if rows != None:
+            r['data'] = iter(rows)
+        try:
+            out.append((i, True, process_query(prepared, eps, r)))
+        except Exception as e:
+            out.append((i, False, str(e)))
+    return out
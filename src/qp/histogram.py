@@ -15,59 +15,83 @@
 #
 ################################################################################
 
-__all__ = ['discretize_data', 'noisy_histogram', 'max_size']
+__all__ = ['discretize_data', 'noisy_histogram', 'max_size', 'column_bins',
+           'count_cells', 'label_cells', 'noisy_cells', 'max_codes',
+           'encode_data', 'encode_cells', 'count_codes', 'noisy_codes',
+           'estimate_cells']
 
-from distributions import rlaplace, plaplace, rbinom
+from distributions import rlaplace_n, rlaplace_tail_n, plaplace, rbinom
 from operator import mul
 from sampler import *
-from itertools import islice
 from math import floor, exp, log
+import numpy as np
 max_size = 500000
+max_codes = 2**62 # histograms with more cells are handled without numpy
 
-def discretize_data(row_iterator, col_names, dmeta, nbin_min=2):
-    data = map(tuple, row_iterator)
+def histogram_nbin(size, dim, nbin_min=2):
+    '''the number of bins numeric columns are discretized into'''
+    nbin = max(nbin_min, int(floor(1.0/pow((log(size)/size), (1.0/(dim + 1))))))
+    if nbin < 1:
+        raise ValueError('Dataset too small: nbin < 1.')
+    return nbin
+
+def column_bins(col_names, dmeta, nbin_min=2):
+    '''per column value labels and bin specifications
+
+       A bin specification is None for categorical columns and
+       (a, b, w, nbin) for numeric columns, where a and b are the
+       bounds and w the bin width. Bin i of a numeric column holds
+       values v with floor((max(a, min(v, b)) - a)/w) == i.'''
     attd = dmeta['attributes']
     types = map(lambda cn : attd[cn]['type'], col_names)
-    dim = len(types)    
-    n = len(data)
+    dim = len(types)
     size = dmeta['size']
-    print 'dataset size', size
-    print 'dims', dim
-    print 'n', n
 
     if any(map(lambda x : x > 2, types)):
         raise ValueError('histogram: can only use columns that are categorical or numeric.')
 
-    nbin = max(nbin_min, int(floor(1.0/pow((log(size)/size), (1.0/(dim + 1))))))
-
-    if nbin < 1:
-        raise ValueError('Dataset too small: nbin < 1.')
-
+    nbin = histogram_nbin(size, dim, nbin_min)
     print 'nbin:', nbin
 
     values = []
-    newcolv = []
-    colv = zip(*data)
-    
+    bins = []
     for i,cn in enumerate(col_names):
         if types[i] == 0:
             vals = attd[cn]['values'].keys()
-            if n > 0:
-                newcol = colv[i]
+            bins.append(None)
         else:
-            #print cn
             a = attd[cn]['bounds']['lower']
             b = attd[cn]['bounds']['upper']
             extra = float(b-a)/1000
             w = float((b+extra)-a)/nbin # avoid index overflow if upper bound is encoutered
             mids = map(lambda i : a + i*w + w/2, range(nbin))
             vals = map(lambda v : '[' + str(v - w/2) + ', ' + str(v + w/2) + ')', mids)
-            check_bounds = lambda x : max(a, min(x, b)) # 'Windsorize' value
-            if n > 0:
-                newcol = map(lambda v : vals[int(floor((check_bounds(v) - a)/w))], colv[i])
+            bins.append((a, b, w, nbin))
         values.append(vals)
-        if n > 0:
-            newcolv.append(newcol)
+    return (values, tuple(bins))
+
+def discretize_data(row_iterator, col_names, dmeta, nbin_min=2):
+    data = map(tuple, row_iterator)
+    n = len(data)
+    print 'dataset size', dmeta['size']
+    print 'dims', len(col_names)
+    print 'n', n
+
+    values, bins = column_bins(col_names, dmeta, nbin_min)
+
+    newcolv = []
+    colv = zip(*data)
+    
+    for i,vals in enumerate(values):
+        if n == 0:
+            continue
+        if bins[i] == None:
+            newcol = colv[i]
+        else:
+            (a, b, w, nbin) = bins[i]
+            check_bounds = lambda x : max(a, min(x, b)) # 'Windsorize' value
+            newcol = map(lambda v : vals[int(floor((check_bounds(v) - a)/w))], colv[i])
+        newcolv.append(newcol)
     
     #sizes = map(len, values)
     #print 'sizes', sizes
@@ -78,21 +102,41 @@ def discretize_data(row_iterator, col_names, dmeta, nbin_min=2):
 
     return(values, discdata)
 
-
-def noisy_histogram(values, discdata, A, eps = 1, tau = None):
-    sizes = map(len, values) # attribute co-domain sizes
-    print 'sizes', sizes
-    #print 'values', values
-    N = reduce(mul, sizes) # size of full histogram
-    print 'N: ', N
-        
+def count_cells(discdata):
+    '''count the rows in each (non-empty) histogram cell'''
     datad = {}
     for row in map(tuple, discdata):
         if datad.has_key(row):
             datad[row] += 1
         else:
             datad[row] = 1
+    return datad
+
+def label_cells(values, bins, cells):
+    '''translate (key, count) pairs computed by the backend
+
+       key holds the value of categorical columns and the bin index of
+       numeric columns. Returns a dict of cell label tuples to counts.'''
+    datad = {}
+    for key, c in cells:
+        row = tuple(k if bins[i] == None else values[i][min(int(k), len(values[i]) - 1)]
+                    for i, k in enumerate(key))
+        datad[row] = datad.get(row, 0) + c
+    return datad
 
+def noisy_histogram(values, discdata, A, eps = 1, tau = None, rng = None):
+    return noisy_cells(values, count_cells(discdata), A, eps, tau, rng)
+
+def noisy_cells(values, datad, A, eps = 1, tau = None, rng = None):
+    '''perturb and truncate the cell counts in datad
+
+       The noise is drawn from rng (see distributions.generator).'''
+    sizes = map(len, values) # attribute co-domain sizes
+    print 'sizes', sizes
+    #print 'values', values
+    N = reduce(mul, sizes) # size of full histogram
+    print 'N: ', N
+        
     exclude = set(datad.keys())
     n = len(exclude)
     print 'n: ', n 
@@ -112,7 +156,7 @@ def noisy_histogram(values, discdata, A, eps = 1, tau = None):
     print 'N-n:', N-n
     nzero = 0
     if N - n > 0:
-        nzero = rbinom(N-n, p) # expected to be int(round(p * (N - n))) 
+        nzero = rbinom(N-n, p, rng = rng) # expected to be int(round(p * (N - n))) 
     print 'extra samples : ', nzero, 'expected:', int(round(p * (N - n)))
 
     if nzero + n > max_size:
@@ -121,26 +165,134 @@ def noisy_histogram(values, discdata, A, eps = 1, tau = None):
     for nam, rw in sorted(datad.items(), key = lambda (_,x) : x, reverse=True)[0:max(20, len(datad))]:
         print nam, ':', rw
 
-    for k, c in datad.items():
-        noisy = rlaplace(scale = b, location = c)
-        if noisy < tau:
-            del datad[k]
-        else:
-            datad[k] = int(round(noisy))
+    keys = datad.keys()
+    noisy = rlaplace_n(n, scale = b, location = np.array(map(lambda k : datad[k], keys)), rng = rng)
+    datad = dict((k, int(round(v))) for (k, v) in zip(keys, noisy.tolist()) if v >= tau)
 
     #######   sample      ##
     print 'sampling', nzero, '...'
-    newvals = sample_new_rows(nzero, values, exclude)
+    newvals = sample_new_rows(nzero, values, exclude, rng)
 
     # create dict and add
-    datad2 = {}
-    for row in newvals:
-        datad2[row] = int(round(rlaplace(scale = b, r = plb)))
-
-    datad.update(datad2)
+    newnoisy = np.round(rlaplace_tail_n(nzero, scale = b, tau = tau, rng = rng)).astype(np.int64)
+    datad.update(zip(newvals, newnoisy.tolist()))
     return datad
 
-def sample_new_rows(n, values_list, exclude_tuples):
+#### numpy versions of the above. Cells are identified by their
+#### mixed radix number (see sampler.mr_toint) over the per column
+#### value indices, and labels are only made for released cells.
+
+def column_index(col, vals, spec):
+    '''value indices of the column col as a numpy array'''
+    if spec == None:
+        (u, inv) = np.unique(np.asarray(col, dtype=object), return_inverse=True)
+        td = dict((x, i) for i, x in enumerate(vals))
+        return np.array(map(lambda x : td[x], u), dtype=np.int64)[inv]
+    (a, b, w, nbin) = spec
+    x = np.clip(np.asarray(col, dtype=float), a, b) # 'Windsorize' values
+    return np.minimum(np.floor((x - a)/w), nbin - 1).astype(np.int64)
+
+def mr_codes(indices, bases):
+    '''vectorized mr_toint over columns of value indices'''
+    codes = np.zeros(len(indices[0]) if indices else 0, dtype=np.int64)
+    for (idx, base) in zip(indices, bases):
+        codes = codes * base + idx
+    return codes
+
+def mr_indices(codes, bases):
+    '''vectorized mr_fromint: the columns of value indices of the codes'''
+    if len(bases) == 0:
+        return []
+    return list(np.unravel_index(np.asarray(codes, dtype=np.int64), bases))
+
+def code_labels(values, codes):
+    '''the cell (tuple of value labels) of each code'''
+    cols = map(lambda (vals, idx) : np.array(vals, dtype=object)[idx].tolist(),
+               zip(values, mr_indices(codes, map(len, values))))
+    return zip(*cols) if cols else [()] * len(codes)
+
+def encode_data(row_iterator, values, bins):
+    '''mixed radix cell numbers for the rows'''
+    data = map(tuple, row_iterator)
+    if len(data) == 0:
+        return np.zeros(0, dtype=np.int64)
+    colv = zip(*data)
+    indices = map(lambda (col, vals, spec) : column_index(col, vals, spec),
+                  zip(colv, values, bins))
+    return mr_codes(indices, map(len, values))
+
+def encode_cells(values, bins, cells):
+    '''mixed radix cell numbers and counts of (key, count) pairs
+       computed by the backend (see label_cells)'''
+    if len(cells) == 0:
+        return (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64))
+    (keys, counts) = zip(*cells)
+    indices = map(lambda (col, vals, spec) :
+                  column_index(col, vals, None) if spec == None else
+                  np.minimum(np.asarray(col, dtype=np.int64), spec[3] - 1),
+                  zip(zip(*keys), values, bins))
+    return count_codes(mr_codes(indices, map(len, values)),
+                       np.array(counts, dtype=np.int64))
+
+def count_codes(codes, weights = None):
+    '''distinct cell numbers and their counts'''
+    (u, inv) = np.unique(codes, return_inverse=True)
+    return (u, np.bincount(inv, weights, len(u)).astype(np.int64))
+
+def noisy_codes(values, codes, counts, A, eps = 1, tau = None, rng = None):
+    '''perturb and truncate the cell counts, as noisy_cells'''
+    sizes = map(len, values)
+    N = reduce(mul, sizes, 1)
+    n = len(codes)
+    print 'N: ', N, 'n: ', n
+    if tau == None:
+        tau = A * log(1 if n == 0 else n) / eps 
+    print 'tau', tau
+
+    b = 2.0/eps
+    p = 0.5 * exp(-tau/b)
+    assert(p < 1)
+    nzero = 0
+    if N - n > 0:
+        nzero = rbinom(N-n, p, rng = rng)
+    print 'extra samples : ', nzero, 'expected:', int(round(p * (N - n)))
+
+    if nzero + n > max_size:
+        raise ValueError('Histogram too large.')
+
+    exclude = codes
+    noisy = rlaplace_n(n, scale = b, location = counts, rng = rng)
+    keep = noisy >= tau
+    codes = codes[keep]
+    noisy = np.round(noisy[keep]).astype(np.int64)
+
+    print 'sampling', nzero, '...'
+    newcodes = sample_excluding(N, nzero, exclude, rng)
+    newnoisy = np.round(rlaplace_tail_n(nzero, scale = b, tau = tau, rng = rng)).astype(np.int64)
+
+    return dict(zip(code_labels(values, np.concatenate((codes, newcodes))),
+                    np.concatenate((noisy, newnoisy)).tolist()))
+
+def estimate_cells(values, size, A, eps = 1, tau = None):
+    '''expected histogram size from the metadata alone
+
+       The number n of non-empty cells is not known before the data
+       is scanned, but 0 <= n <= min(N, size). The table that
+       noisy_cells and noisy_codes check against max_size has n +
+       Binomial(N - n, p) entries, so its expected size is between p*N
+       and p*N + (1-p)*min(N, size).'''
+    N = reduce(mul, map(len, values), 1)
+    nmax = min(N, size)
+    if tau == None:
+        tau = A * log(max(1, nmax)) / eps
+    p = 0.5 * exp(-tau/(2.0/eps))
+    return {'domain' : N,
+            'nonempty' : (0, nmax),
+            'sampled' : (p * (N - nmax), p * N),
+            'cells' : (p * N, p * N + (1 - p) * nmax),
+            'limit' : max_size}
+
+def sample_new_rows(n, values_list, exclude_tuples, rng = None):
     bases = map(len, values_list)
     N = reduce(mul, bases, 1)
     tdict = transd(values_list)
@@ -148,11 +300,13 @@ def sample_new_rows(n, values_list, exclude_tuples):
     usednums = map(lambda row : mr_toint(row, bases), di)
     print 'usednums', len(usednums)
     print 'N', N
-    sampleit = worsample(N, usednums)
-    newnums = list(islice(sampleit, n))
+    newnums = sample_excluding(N, n, usednums, rng)
     print 'sampled', len(newnums)
-    di = map(lambda x : mr_fromint(x, bases), newnums)
-    newvals = map(tuple, irows2nam(values_list, di))
+    if N > max_codes: # beyond numpy integers
+        di = map(lambda x : mr_fromint(x, bases), newnums)
+        newvals = map(tuple, irows2nam(values_list, di))
+    else:
+        newvals = code_labels(values_list, newnums)
     print 'newvals', len(newvals)
     return newvals
 
@@ -13,6 +13,27 @@
 #                              'data' - a row tuple generator function
 #                              'attributes' - the data table attributes
 #                              'setd' - data set metadata
+#                'aggregate' : optional function f(parms, setd, attributes)
+#                              returning an aggregate specification
+#                              (see backend.aggregates) or None. If a
+#                              specification is returned, result
+#                              holds the aggregate entries (e.g.,
+#                              'count') instead of 'data'.
+#                'estimate' : optional function f(eps, parms, setd, attributes)
+#                             returning a dict describing the cost of
+#                             the query, computed from the metadata
+#                             alone. If it has an entry 'cells', a
+#                             (low, high) range of the expected number
+#                             of cells, queries with low above the
+#                             entry 'limit' or the server's cell limit
+#                             are rejected before the risk is charged.
+#                'cpu_bound' : optional, if True the processor is run
+#                              in the process pool if the server has one.
+#                'input' : optional, if 'columns', result holds
+#                          'columns', a dict of attribute name to numpy
+#                          array, and 'labels', a dict of categorical
+#                          attribute name to the list of values its
+#                          integer codes index, instead of 'data'.
 #                'name' : the name of the processor
 #                'meta' : a meta data dict with entries
 #                         'name', 'explanation', 'parameters'
@@ -43,19 +64,31 @@
 
 __all__ = ['processors']
 
-from random import random
-from math import log, pow, exp, floor
+from math import log, pow, floor
+from operator import mul
 
-from distributions import rlaplace
-from histogram import discretize_data, noisy_histogram
+from distributions import rlaplace, rpowerexp
+from histogram import discretize_data, count_cells, noisy_cells, column_bins, label_cells
+from histogram import max_codes, encode_data, encode_cells, count_codes, noisy_codes
+from histogram import estimate_cells
 
 
-######## Simple count processor
-def simple_count(eps, parms, result):
-    '''simple laplace noise added to row count and then rounded'''
+def row_count(result):
+    '''the number of matching rows, computed by the backend if possible'''
+    if result.has_key('count'):
+        return result['count']
     count = 0
     for r in result['data']:
         count += 1
+    return count
+
+# aggregate specification for processors that only need the row count
+count_aggregate = lambda parms, setd, attributes : ('count',)
+
+######## Simple count processor
+def simple_count(eps, parms, result):
+    '''simple laplace noise added to row count and then rounded'''
+    count = row_count(result)
     out = int(round(rlaplace(2.0/eps, count)))
     return {'count' : out }
 
@@ -67,6 +100,7 @@ simple_count_meta = {'name' : 'Simple_Count',
 proc_simple_count = {
     'name': 'Simple_Count',
     'f' : simple_count,
+    'aggregate' : count_aggregate,
     'meta' : simple_count_meta
     }
 
@@ -119,9 +153,7 @@ user_pref_count_meta = {
 
 def user_pref_count(eps, parms, result):
     '''perturbed count with user preferences'''
-    count = 0
-    for r in result['data']:
-        count += 1
+    count = row_count(result)
     pdict = dict(parms)
 
     bp = pdict['beta_plus']
@@ -131,31 +163,8 @@ def user_pref_count(eps, parms, result):
 
     size = result['setd']['size']
 
-    def cumsum(p):
-        s = 0
-        for x in p:
-            yield (x + s)
-            s += x
-
-    def sample(p):
-        #assert(sum(p) == 1.0)
-        what = random()
-        i = 0
-        for s in cumsum(p):
-            if s >= what:
-                return i
-            i += 1
-        return i - 1
-
-    def util(r):
-        if r >= count:
-            return -bp * pow(r - count, ap)
-        else:
-            return -bn * pow(count - r, an)
-    
-    def genEM(eta):
-        return lambda r : exp(eta * util(r))
-
+    # the utility of r is -bp * pow(r - count, ap) if r >= count
+    # and -bn * pow(count - r, an) otherwise
     def comp_eta():
         delta = max(bp, bn)
         if an > 1:
@@ -165,21 +174,14 @@ def user_pref_count(eps, parms, result):
         return eps/(2 * delta)
 
     eta = comp_eta()
-    emf = genEM(eta)
-
-    def genPM():
-        N = sum(map(emf, range(size)))
-        return lambda r : emf(r)/N
-
-    pfun = genPM()
-
-    p = map(pfun, range(size))
-    i = sample(p)
+    # sample r in range(size) with probability proportional to exp(eta * util(r))
+    i = rpowerexp(count, size, eta * bp, ap, eta * bn, an)
     return { 'count' : i}
 
 proc_user_pref_count = {
     'name': 'Tuned_Count',
     'f' : user_pref_count,
+    'aggregate' : count_aggregate,
     'meta' : user_pref_count_meta
     }
 
@@ -216,19 +218,44 @@ def histogram(eps, parms, result):
     col_names = result['attributes']
     dmeta = result['setd']
     pdict = dict(parms)
-    data = list(result['data'])
     A = pdict['A']
     nbin_min = pdict['MinBins']
     tau = A * log(dmeta['size']) / float(eps)
-    values, discdata = discretize_data(data, col_names, dmeta, nbin_min)
-    h = noisy_histogram(values, discdata, A = pdict['A'], eps = eps, tau=tau)
+    values, bins = column_bins(col_names, dmeta, nbin_min)
+    if reduce(mul, map(len, values), 1) < max_codes: # numpy
+        if result.has_key('cells'): # counted by the backend
+            (codes, counts) = encode_cells(values, bins, result['cells'])
+        else:
+            (codes, counts) = count_codes(encode_data(result['data'], values, bins))
+        h = noisy_codes(values, codes, counts, A = pdict['A'], eps = eps, tau=tau)
+    else:
+        if result.has_key('cells'):
+            datad = label_cells(values, bins, result['cells'])
+        else:
+            values, discdata = discretize_data(result['data'], col_names, dmeta, nbin_min)
+            datad = count_cells(discdata)
+        h = noisy_cells(values, datad, A = pdict['A'], eps = eps, tau=tau)
     return {'col_names' : col_names, 'histogram' : h}
 
+def histogram_aggregate(parms, setd, attributes):
+    '''let the backend count the rows in each cell'''
+    (values, bins) = column_bins(attributes, setd, dict(parms)['MinBins'])
+    return ('cells', bins)
+
+def histogram_estimate(eps, parms, setd, attributes):
+    '''the expected number of cells, before the data is scanned'''
+    pdict = dict(parms)
+    (values, bins) = column_bins(attributes, setd, pdict['MinBins'])
+    tau = pdict['A'] * log(setd['size']) / float(eps)
+    return estimate_cells(values, setd['size'], pdict['A'], eps = eps, tau = tau)
 
     
 proc_histogram = {
     'name': 'Histogram',
     'f' : histogram,
+    'aggregate' : histogram_aggregate,
+    'estimate' : histogram_estimate,
+    'cpu_bound' : True,
     'meta' : histogram_meta
     }
         
@@ -29,9 +29,10 @@
 #
 ################################################################################
 
-__all__ = ['init_factory', 'Address', 'RiskClientFactory']
+__all__ = ['init_factory', 'Address', 'RiskClientFactory', 'RiskChannel']
 
 from twisted.internet.protocol import Factory, ClientFactory
+from twisted.internet.defer import Deferred, DeferredList
 from ..gpgproto import GPGProtocol
 from frontend import init_frontend
 import imp
@@ -39,7 +40,13 @@ import os
 import signal
 
 from ..messages import *
-from frontend import handle_query
+from frontend import group_queries, handle_group
+from frontend import prepare_query, prefetch_query, process_query
+from frontend import preflight, estimate_query, check_estimate
+from workers import ServerBusy, ThreadWorkers, ProcessWorkers
+from replay import ReplayStore
+from cube import init_cubes, cube_location
+from bitmap import init_bitmaps
 from twisted.internet import reactor
 from logging import error, warning, info, debug
 
@@ -58,7 +65,9 @@ class ServerState:
                  risk_address,
                  frontend,
                  allow_alias = False,
-                 allow_echo=False):
+                 allow_echo=False,
+                 max_in_flight = 16,
+                 speculate = False):
 
         self.gpg = gpg # gpg instance
         self.me = me # my key identifier
@@ -67,7 +76,12 @@ class ServerState:
         self.frontend = frontend
         self.allow_alias = allow_alias
         self.allow_echo = allow_echo
+        self.max_in_flight = max_in_flight # per connection
+        self.speculate = speculate # fetch data while the RA decides
         self.loadf = lambda _ : None
+        self.workers = None # pool running data queries
+        self.process_workers = None # pool running cpu bound queries
+        self.replay = None # store of released responses
 
         
     def reload_frontend(self):
@@ -81,7 +95,6 @@ class ServerProtocol(GPGProtocol):
     
     def __init__(self, state):
         GPGProtocol.__init__(self, state.gpg, state.me)
-        self.risk_pending = False
         self.state = state
         self.handler = ClientHandler(self)
 
@@ -106,73 +119,149 @@ class ServerFactory(Factory):
 #### Client protocol for talking to Risk Accountant
 
 class RiskClientProtocol(GPGProtocol):
+    '''persistent connection to the risk accountant
 
-    def __init__(self, server):
+       Queries are tagged with a correlation id so that any number of
+       them can be in flight at the same time.'''
+
+    def __init__(self, channel):
+        state = channel.state
         GPGProtocol.__init__(self,
-                             server.state.gpg,
-                             server.state.me,
-                             server.state.ra, # talk to ra 
-                             [server.state.ra]) # only allow contact with
-        self.server = server
-    
+                             state.gpg,
+                             state.me,
+                             state.ra, # talk to ra 
+                             [state.ra], # only allow contact with
+                             session = state.ra_session)
+        self.channel = channel
+        self.pending = {} # rid -> Deferred
+
+    def query(self, q, d):
+        self.pending[q.rid] = d
+        self.sendMessage(q)
+
     def messageReceived(self, message):
-        # pass on to server protocol
-        self.server.risk_pending = False
-        self.transport.loseConnection() # close down risk server connection
-        self.server.handler.collect(message)
+        rar = RAResponse.parse(message)
+        if rar == None:
+            error('Invalid reponse from RA:' + message)
+            return
+        if not self.pending.has_key(rar.rid):
+            error('Unexpected reponse from RA:' + message)
+            return
+        self.pending.pop(rar.rid).callback(rar)
 
     def connectionMade(self):
-        # send packet
-        self.server.risk_pending = True        
-        self.sendMessage(self.server.handler.pending)
+        self.channel.connected(self)
+
+    def connectionLost(self, reason):
+        self.channel.lost(self)
+        pending = self.pending.values()
+        self.pending = {}
+        for d in pending:
+            d.errback(Exception('Lost connection to Risk Accountant'))
 
 
 class RiskClientFactory(ClientFactory):
-    def __init__(self, server):
-        self.server = server # the query server instance
+    def __init__(self, channel):
+        self.channel = channel
         
     def buildProtocol(self, addr):
-        '''build protocol that passes on packet from factory'''
-        print 'Connected.'
-        return RiskClientProtocol(self.server)
+        print 'Connected to Risk Accountant.'
+        return RiskClientProtocol(self.channel)
 
     def clientConnectionFailed(self, connector, reason):
-        self.server.risk_pending = False            
         why = str(reason).split(':')[-1][:-1].strip()
-        self.server.sendMessage(QPInternalError(
-            'Could not connect to Risk Accountant'))
-        self.server.transport.loseConnection()
-        
-    def clientConnectionLost(self, connector, reason):
-        if self.server.risk_pending:
-            self.server.risk_pending = False
-            why = str(reason).split(':')[-1][:-1].strip()
-            self.server.sendMessage(QPInternalError(
-                'Lost connection to Risk Accountant'))
-            self.server.transport.loseConnection()
+        error('Could not connect to Risk Accountant: ' + why)
+        self.channel.failed()
+
+
+class RiskChannel:
+    '''a pool of long-lived authenticated connections to the risk accountant
+
+       query(q) returns a Deferred that fires with the RAResponse.
+       Connections are opened on demand, up to size of them.'''
+
+    def __init__(self, state, size = 1, timeout = 3):
+        self.state = state
+        self.size = size
+        self.timeout = timeout
+        self.connections = []
+        self.connecting = 0
+        self.waiting = [] # (query, Deferred) waiting for a connection
+        self.last_id = 0
+
+    def query(self, q):
+        d = Deferred()
+        self.last_id += 1
+        q.rid = self.last_id
+        idle = filter(lambda c : not c.pending, self.connections)
+        if not idle and len(self.connections) + self.connecting < self.size:
+            self.connect()
+        if self.connections:
+            min(self.connections, key = lambda c : len(c.pending)).query(q, d)
+        else:
+            self.waiting.append((q, d))
+        return d
+
+    def connect(self):
+        self.connecting += 1
+        reactor.connectTCP(self.state.risk_address.addr,
+                           self.state.risk_address.port,
+                           RiskClientFactory(self), self.timeout)
+
+    def connected(self, proto):
+        self.connecting -= 1
+        self.connections.append(proto)
+        waiting = self.waiting
+        self.waiting = []
+        for (q, d) in waiting:
+            proto.query(q, d)
+
+    def lost(self, proto):
+        if proto in self.connections:
+            self.connections.remove(proto)
+
+    def failed(self):
+        self.connecting -= 1
+        if self.connections or self.connecting:
+            return
+        waiting = self.waiting
+        self.waiting = []
+        for (q, d) in waiting:
+            d.errback(Exception('Could not connect to Risk Accountant'))
 
 #### Handling client requests
 
 
 class ClientHandler:
+    '''handles the requests on a connection
+
+       Any number of requests, up to state.max_in_flight, can be
+       handled at the same time. Responses to requests with an id carry
+       the id and are sent as soon as they are ready. Responses to
+       requests without an id are sent in the order the requests came in.'''
 
     def __init__(self, clientProtocol):
         self.proto = clientProtocol
         self.request = None
         self.user_id = None
-        self.pending = None
+        self.in_flight = 0
+        self.ordered = [] # [request, response] for requests without id
         self.handler = [self.handle_meta,
                         self.handle_ra,
                         self.handle_ra,
-                        self.handle_echo]
+                        self.handle_echo,
+                        self.handle_batch,
+                        self.handle_estimate]
         self.collector = { QP_INFO : self.collect_info,
-                           QP_RISK : self.collect_risk }
+                           QP_RISK : self.collect_risk,
+                           QP_BATCH : self.collect_batch }
             
 
     def dispatch(self, request):
         r = QPRequest.parse(request)
         if r == None:
-            self.proto.sendMessage(QPBadRequest(request))
+            self.ordered.append([None, QPBadRequest(request)])
+            self.flush()
             return
 
         self.request = r
@@ -180,75 +269,307 @@ class ClientHandler:
         self.user_id = self.proto.peer_key
         if self.proto.state.allow_alias and r.alias != None:
             self.user_id = r.alias
+        r.user_id = self.user_id
+
+        if r.rid == None:
+            self.ordered.append([r, None])
+        if self.in_flight >= self.proto.state.max_in_flight:
+            self.in_flight += 1
+            self.reply(r, QPBusyError('Too many requests in flight.', r.type))
+            return
+        self.in_flight += 1
 
         try:
             self.handler[r.type](r)
         except Exception as e:
             print 'exception:', e
-            self.proto.sendMessage(QPInternalError('Sorry.'))
+            self.reply(r, QPInternalError('Sorry.'))
+
+    def reply(self, r, response):
+        '''send the response to request r'''
+        self.in_flight -= 1
+        if r.rid != None:
+            response.rid = r.rid
+            self.proto.sendMessage(response)
+            return
+        for entry in self.ordered:
+            if entry[0] is r:
+                entry[1] = response
+        self.flush()
+
+    def flush(self):
+        while self.ordered and self.ordered[0][1] != None:
+            self.proto.sendMessage(self.ordered.pop(0)[1])
             
     def handle_meta(self, r):
         print ('Sending metadata to ' +
              str(self.proto.peer) + '(' + str(self.proto.peer_key) + ')')
-        info('Served: ' + str((self.user_id, str(self.request))))
-        self.proto.sendMessage(
-            QPResponse(QP_OK, r.type, self.proto.state.frontend['meta']))
+        info('Served: ' + str((r.user_id, str(r))))
+        self.reply(r, QPResponse(QP_OK, r.type, self.proto.state.frontend['meta']))
+
+    def workers_for(self, r):
+        '''the pool the data query in request r is to be run in'''
+        state = self.proto.state
+        try:
+            pname = r.params[1][0]
+            cpu_bound = state.frontend['processors'][pname].get('cpu_bound', False)
+        except Exception:
+            return state.workers
+        if (cpu_bound and state.process_workers != None and
+            pname in state.process_workers.processors):
+            return state.process_workers
+        return state.workers
+
+    def replay_or_ask(self, r):
+        '''answer r with an already released response if there is one,
+           otherwise ask the RA
+
+           The data set version is read by the backend in a worker
+           thread, so that a replaced data set is not answered from.'''
+        state = self.proto.state
+        try:
+            name = r.params[0][0]
+            known = name in state.frontend['meta']['datasets']
+        except Exception:
+            known = False
+        if not known: # rejected by preflight
+            self.ask(r)
+            return
+        backend = state.frontend['backend']
+        if not backend.has_key('version'):
+            self.no_replay(r, name, 'the backend does not keep data set versions')
+            return
+        d = state.workers.run(backend['version'], backend, name)
+        d.addCallbacks(self.replay_lookup, lambda f : self.no_replay(r, name, f.getErrorMessage()),
+                       callbackArgs = (r, name))
+        d.addErrback(self.internal_error, r)
+
+    def no_replay(self, r, name, reason):
+        replay = self.proto.state.replay
+        if name not in replay.unavailable:
+            replay.unavailable.add(name)
+            warning('No replay for ' + name + ': ' + reason)
+        self.ask(r)
+
+    def replay_lookup(self, version, r, name):
+        '''replay the response to r if there is one. Responses released
+           to another user are only replayed once the RA knows r's user.'''
+        if version == None: # a re-import could not be noticed
+            self.no_replay(r, name, 'the data set has no version')
+            return
+        replay = self.proto.state.replay
+        r.replay_key = replay.key(r.user_id, r.eps, r.params, version)
+        response = replay.get(r.replay_key) if r.replay_key != None else None
+        if response == None:
+            self.ask(r)
+        elif replay.per_user:
+            self.replay(r, response)
+        else:
+            d = self.proto.state.ra_channel.query(RAQuery(RA_INFO, r.user_id, r.eps))
+            d.addCallbacks(self.replay_known, self.ra_failed,
+                           callbackArgs = (r, response), errbackArgs = (r, None))
+
+    def replay_known(self, rar, r, response):
+        if rar.status == RA_ERROR_USER:
+            self.reply(r, QPBadRequest('User not found.', r.type))
+        elif rar.status > RA_OK:
+            error('RA error: ', str(rar))
+            self.reply(r, QPInternalError('Sorry.'))
+        else:
+            self.replay(r, response)
+
+    def replay(self, r, response):
+        info('Replayed: ' + str((r.user_id, str(r))))
+        self.reply(r, QPOK(response, r.type))
+
+    def internal_error(self, failure, r):
+        print 'exception:', failure.getErrorMessage()
+        self.reply(r, QPInternalError('Sorry.'))
 
     def handle_ra(self, r):
+        r.slots = 1 # worker slots reserved for the request
+        r.replay_key = None
+        if r.type == QP_INFO and self.proto.state.replay != None:
+            self.replay_or_ask(r)
+        else:
+            self.ask(r)
+
+    def ask(self, r):
+        '''ask the RA about r, after reserving a worker slot for an
+           information request'''
+        workers = None
+        if r.type == QP_INFO: # reject queries expected to fail before the RA charges them
+            try:
+                (r.prepared, r.estimate) = preflight(self.proto.state.frontend, r.eps, r.params)
+            except Exception as e:
+                self.reply(r, QPBadRequest(str(e), r.type))
+                return
+        if r.type == QP_INFO: # make sure a granted query can be run
+            workers = self.workers_for(r)
+            try:
+                workers.reserve()
+            except ServerBusy as e:
+                self.reply(r, QPBusyError(str(e), r.type))
+                return
+            self.speculate(r, workers)
+        self.check(r, RA_CHECK if r.type == QP_INFO else RA_INFO, r.eps, workers)
+
+    def speculate(self, r, workers):
+        '''start fetching the data for r before the RA has granted it
+
+           The fetch runs in the slot reserved for r. Nothing is
+           released before the grant: the processor, which adds the
+           noise, is only run after it. Queries run in the process pool
+           are not fetched ahead, as their data cannot be handed over.'''
+        r.fetched = None
+        state = self.proto.state
+        if not state.speculate or not isinstance(workers, ThreadWorkers):
+            return
+        r.fetched = workers.run(prefetch_query, state.frontend, r.prepared)
+
+    def discard(self, r, workers):
+        '''release the slots of r, which will not be run
+
+           Data fetched ahead for r is forgotten. The slot it is
+           fetched in is only released when the fetch is done.'''
+        if getattr(r, 'fetched', None) != None:
+            r.fetched.addBoth(lambda _ : self.release(r, workers))
+            r.fetched = None
+        else:
+            self.release(r, workers)
+
+    def check(self, r, ra_type, eps, workers):
+        '''ask the risk accountant, then collect'''
         print 'querying risk accountant...'
-        ra_type = RA_CHECK if r.type == QP_INFO else RA_INFO
-        self.pending = RAQuery(ra_type, self.user_id, r.eps)
-        factory = RiskClientFactory(self.proto)
-        reactor.connectTCP(
-            self.proto.state.risk_address.addr,
-            self.proto.state.risk_address.port,
-            factory, 3)
+        d = self.proto.state.ra_channel.query(RAQuery(ra_type, r.user_id, eps))
+        d.addCallbacks(self.collect, self.ra_failed,
+                       callbackArgs = (r, workers), errbackArgs = (r, workers))
+
+    def release(self, r, workers):
+        '''release the worker slots reserved for request r'''
+        if workers != None:
+            map(lambda _ : workers.release(), range(r.slots))
+
+    def handle_batch(self, r):
+        '''one risk check for the summed risk of a list of queries'''
+        state = self.proto.state
+        try:
+            queries = list(r.params)
+            if len(queries) == 0:
+                raise Exception('Empty batch.')
+            r.groups = group_queries(state.frontend, queries)
+            eps = sum(map(lambda (e, _) : e, queries))
+        except Exception as e:
+            self.reply(r, QPBadRequest('Malformed batch: ' + str(e), r.type))
+            return
+        workers = state.workers # one slot per group of queries sharing a scan
+        r.slots = 0
+        try:
+            for g in r.groups:
+                workers.reserve()
+                r.slots += 1
+        except ServerBusy as e:
+            self.release(r, workers)
+            self.reply(r, QPBusyError(str(e), r.type))
+            return
+        self.check(r, RA_CHECK, eps, workers)
 
-    def handle_echo(self, r):
-        info('Served: ' + str((self.user_id, str(self.request))))
-        self.proto.sendMessage(QPResponse(QP_OK, r.type, str(r)))
+    def ra_failed(self, failure, r, workers):
+        self.discard(r, workers)
+        error('RA failure: ' + failure.getErrorMessage())
+        self.reply(r, QPInternalError(failure.getErrorMessage()))
 
-    def collect(self, message):
-        rar = RAResponse.parse(message)
-        if rar == None:
-            error('Invalid reponse from RA:' + message)
-            self.proto.sendMessage(QPInternalError('Sorry.'))
+    def handle_estimate(self, r):
+        '''the estimated cost of a query, from the metadata alone
+
+           The RA is not asked and no risk is incurred.'''
+        frontend = self.proto.state.frontend
+        try:
+            estimate = estimate_query(frontend, r.eps, prepare_query(frontend, r.eps, r.params))
+        except Exception as e:
+            self.reply(r, QPBadRequest(str(e), r.type))
             return
+        try:
+            check_estimate(frontend, estimate)
+            estimate['accepted'] = True
+        except Exception as e:
+            estimate['accepted'] = False
+            estimate['reason'] = str(e)
+        info('Served: ' + str((r.user_id, str(r))))
+        self.reply(r, QPOK(estimate, r.type))
+
+    def handle_echo(self, r):
+        info('Served: ' + str((r.user_id, str(r))))
+        self.reply(r, QPResponse(QP_OK, r.type, str(r)))
+
+    def collect(self, rar, r, workers):
+        if rar.status != RA_OK or rar.f1 != RA_GRANTED:
+            self.discard(r, workers) # the query will not be run
 
         if rar.status == RA_ERROR_USER:
-            self.proto.sendMessage(QPBadRequest('User not found.',
-                                                self.request.type))
+            self.reply(r, QPBadRequest('User not found.', r.type))
             return
         
         if rar.status > RA_OK:
             error('RA error: ', str(rar))
-            self.proto.sendMessage(QPInternalError('Sorry.'))
+            self.reply(r, QPInternalError('Sorry.'))
             return
         try:
-            self.collector[self.request.type](rar)
+            self.collector[r.type](rar, r, workers)
         except Exception as e:
             print 'exception:', e
-            self.proto.sendMessage(QPInternalError('Sorry.'))
+            self.reply(r, QPInternalError('Sorry.'))
         
-    def collect_info(self, rar):
+    def collect_info(self, rar, r, workers):
         if rar.f1 != RA_GRANTED:
-            self.proto.sendMessage(QPBudgetError('Budget exceeded.'))
+            self.reply(r, QPBudgetError('Budget exceeded.'))
             return
-        try:
-            res = handle_query(self.proto.state.frontend,
-                               self.request.eps, self.request.params)
-        except Exception as e:
-            self.proto.sendMessage(QPBadRequest(str(e)))
+        if getattr(r, 'fetched', None) != None: # fetched while the RA decided
+            d = r.fetched
+            d.addCallbacks(lambda res : workers.submit(True, process_query,
+                                                       r.prepared, r.eps, res),
+                           workers.release)
         else:
-            info('Served: ' + str((self.user_id, str(self.request))))
-            self.proto.sendMessage(QPOK(res, self.request.type))
+            d = workers.query(self.proto.state.frontend, r.eps, r.params, True)
+        d.addCallbacks(self.query_done, self.query_failed,
+                       callbackArgs = (r,), errbackArgs = (r,))
+
+    def query_done(self, res, r):
+        info('Served: ' + str((r.user_id, str(r))))
+        if r.replay_key != None:
+            self.proto.state.replay.put(r.replay_key, res)
+        self.reply(r, QPOK(res, r.type))
 
-    def collect_risk(self, rar):
+    def query_failed(self, failure, r):
+        self.reply(r, QPBadRequest(failure.getErrorMessage()))
+
+    def collect_batch(self, rar, r, workers):
+        if rar.f1 != RA_GRANTED:
+            self.reply(r, QPBudgetError('Budget exceeded.', r.type))
+            return
+        frontend = self.proto.state.frontend
+        d = DeferredList(map(lambda g : workers.submit(True, handle_group, frontend, g),
+                             r.groups), consumeErrors = True)
+        d.addCallback(self.batch_done, r)
+
+    def batch_done(self, results, r):
+        '''combine the group results into a list of (status, response)'''
+        responses = [None] * sum(map(len, r.groups))
+        for (g, (ok, res)) in zip(r.groups, results):
+            if not ok: # the shared backend query failed
+                msg = res.getErrorMessage()
+                res = map(lambda (i, e, p) : (i, False, msg), g)
+            for (i, success, value) in res:
+                responses[i] = (QP_OK, value) if success else (QP_ERROR_QUERY, value)
+        info('Served: ' + str((r.user_id, str(r))))
+        self.reply(r, QPOK(responses, r.type))
+
+    def collect_risk(self, rar, r, workers):
         response = { 'total' : rar.f1,
                      'tt' : rar.tt,
                      'qt' : rar.qt }
-        info('Served: ' + str((self.user_id, str(self.request))))
-        self.proto.sendMessage(QPOK(response, self.request.type))
+        info('Served: ' + str((r.user_id, str(r))))
+        self.reply(r, QPOK(response, r.type))
 
 ####
 
@@ -287,9 +608,29 @@ def init_factory(gpg, # initialized gpg
                  ra_address, # the address of the RA
                  allow_alias, # allow clients to query on others' behalf
                  allow_echo, # allow echo request
-                 querymodule): # where to load new queries from
-
-        frontend = init_frontend(database, processors)
+                 querymodule, # where to load new queries from
+                 ra_connections = 1, # max connections to the RA
+                 workers = 4, # threads running data queries
+                 max_queue = 32, # max pending data queries per pool
+                 process_workers = 0, # processes running cpu bound queries
+                 ra_session = False, # use session channels to the RA
+                 max_in_flight = 16, # max requests in flight per connection
+                 speculate = False, # fetch data while the RA decides
+                 replay = None, # None, 'user' or 'global' replay of responses
+                 replay_size = 1024, # max responses kept for replay
+                 replay_file = None, # file the kept responses are saved in
+                 cube = False, # count from materialized contingency cubes
+                 bitmaps = False, # count with bitmap indexes
+                 index_dir = None, # where cubes and bitmap indexes are kept
+                 max_cells = None, # max expected histogram cells
+                 process_timeout = None): # seconds a process query may take
+
+        frontend = init_frontend(database, processors, max_cells = max_cells)
+        # before process workers are started, so they share the indexes
+        if bitmaps:
+            init_bitmaps(frontend['backend'], *cube_location(database, index_dir))
+        if cube:
+            init_cubes(frontend['backend'], *cube_location(database, index_dir))
 
         state = ServerState(
             gpg,
@@ -298,10 +639,23 @@ def init_factory(gpg, # initialized gpg
             ra_address,
             frontend,
             allow_alias = allow_alias,
-            allow_echo  = allow_echo)
+            allow_echo  = allow_echo,
+            max_in_flight = max_in_flight,
+            speculate = speculate)
         
         state.querymodule = querymodule
         state.loadf = reload_frontend
+        state.ra_session = ra_session
+        if process_workers > 0: # forked before any threads are started
+            state.process_workers = ProcessWorkers(process_workers, max_queue,
+                                                   database, processors,
+                                                   process_timeout)
+        state.ra_channel = RiskChannel(state, ra_connections)
+        state.workers = ThreadWorkers(workers, max_queue)
+        if replay != None:
+            state.replay = ReplayStore(replay_size, replay == 'user', replay_file)
+            reactor.addSystemEventTrigger('during', 'shutdown',
+                                          lambda : info(state.replay.report()))
 
         factory = ServerFactory(state)
         
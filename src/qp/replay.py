@@ -0,0 +1,106 @@
+# store of released responses, so that a query asked again can be
+# answered without spending more risk
+
+__all__ = ['ReplayStore']
+
+import os
+from ast import literal_eval
+from collections import OrderedDict
+from logging import warning
+
+from backend import canonical_selection, canonical_spec
+
+class ReplayStore:
+    '''a bounded LRU store of released responses
+
+       Releasing a response again does not increase the privacy risk,
+       so a query identical to one already answered is answered with
+       the same response. If per_user is True, responses are only
+       replayed to the user they were released to.
+
+       If filename is given, entries are appended to it as they are
+       added, and read back when the store is created. The file is
+       rewritten with the current entries when it has grown to hold
+       more than twice the number of entries kept.'''
+
+    def __init__(self, size = 1024, per_user = True, filename = None):
+        self.size = size
+        self.per_user = per_user
+        self.filename = filename
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.logged = 0 # entries in the file
+        self.unavailable = set() # data sets that cannot be replayed
+        self.log = None
+        if filename != None:
+            self.load()
+            self.compact()
+
+    def key(self, user, eps, query, version = None):
+        '''the key of an information query, or None if it cannot be kept'''
+        try:
+            ((dname, sel, pro), (pname, parms)) = query
+            k = (user if self.per_user else None, dname, version,
+                 canonical_selection(sel), tuple(pro), pname,
+                 tuple(sorted(canonical_spec(parms))), float(eps))
+            hash(k)
+            return k
+        except Exception:
+            return None
+
+    def get(self, key):
+        if key not in self.entries:
+            self.misses += 1
+            return None
+        self.hits += 1
+        response = self.entries.pop(key)
+        self.entries[key] = response # most recently used last
+        return response
+
+    def insert(self, key, response):
+        self.entries.pop(key, None)
+        self.entries[key] = response
+        while len(self.entries) > self.size:
+            self.entries.popitem(last = False)
+
+    def put(self, key, response):
+        self.insert(key, response)
+        if self.log != None:
+            try:
+                self.log.write(repr((key, response)) + '\n')
+                self.log.flush()
+                self.logged += 1
+            except Exception as e:
+                warning('Could not write replay file: ' + str(e))
+            if self.logged > 2 * self.size:
+                self.compact()
+
+    def load(self):
+        '''read entries from the file, skipping lines that do not parse'''
+        if not os.path.exists(self.filename):
+            return
+        for line in open(self.filename):
+            try:
+                (key, response) = literal_eval(line)
+                self.insert(key, response)
+            except Exception:
+                pass
+
+    def compact(self):
+        '''rewrite the file with the current entries'''
+        if self.log != None:
+            self.log.close()
+        tmp = self.filename + '.tmp'
+        f = open(tmp, 'w')
+        for item in self.entries.items():
+            f.write(repr(item) + '\n')
+        f.close()
+        os.rename(tmp, self.filename)
+        self.logged = len(self.entries)
+        self.log = open(self.filename, 'a')
+
+    def report(self):
+        '''replay statistics as text'''
+        return ('replay store: ' + str(self.hits) + ' hits, ' + str(self.misses) +
+                ' misses, ' + str(len(self.entries)) + ' entries')
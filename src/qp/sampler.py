@@ -29,10 +29,13 @@
 #
 ################################################################################
 
-__all__ = ['worsample', 'mr_toint', 'mr_fromint', 'nrows2id', 'irows2nam', 'transd' ]
+__all__ = ['worsample', 'mr_toint', 'mr_fromint', 'nrows2id', 'irows2nam', 'transd',
+           'sample_excluding', 'rejection_sample', 'floyd_sample']
 
 
 from random import random, randrange
+import numpy as np
+from distributions import generator
 
 ############# WOR sample [modern implementation of Ernvall and Nevalainen, 1982]
 #An Algorithm for Unbiased Random Sampling
@@ -65,6 +68,95 @@ def worsample(N, exclude = []):
         yield k
         
 
+
+############# sparse WOR sample. worsample needs the whole exclude
+# list sorted and remapped, and draws one number at a time. When N is
+# much larger than the sample and the exclude list, drawing numbers in
+# bulk and rejecting the excluded and repeated ones is cheaper. When
+# they make up a large part of N, Floyd's algorithm draws exactly one
+# number per sample.
+
+max_int = 2**62 # larger populations are sampled with python integers
+dense_ratio = 0.5 # use Floyd's algorithm if (sample + exclude)/N is larger
+
+def first_unique(a):
+    '''the distinct elements of a in order of first occurrence'''
+    (u, idx) = np.unique(a, return_index=True)
+    return a[np.sort(idx)]
+
+def rejection_sample(N, n, exclude = [], rng = None):
+    '''n integers from range(N) not in exclude, by rejection
+
+       Candidates are drawn in bulk and the excluded ones are found
+       by binary search in the sorted exclude array.'''
+    excl = np.unique(np.asarray(exclude, dtype=np.int64))
+    free = N - len(excl)
+    out = np.zeros(0, dtype=np.int64)
+    while len(out) < n:
+        need = n - len(out)
+        draw = int(need * float(N) / max(1, free - len(out)) * 1.1) + 16
+        cand = generator(rng).randint(0, N, size=draw, dtype=np.int64)
+        if len(excl):
+            pos = np.minimum(np.searchsorted(excl, cand), len(excl) - 1)
+            cand = cand[excl[pos] != cand]
+        out = first_unique(np.concatenate((out, cand)))[:n]
+    return out
+
+def floyd_sample(N, n, exclude = [], rng = None):
+    '''n integers from range(N) not in exclude, by Floyd's algorithm
+
+       The sample is drawn from range(N - len(exclude)), and number i
+       is mapped to the i-th integer not in exclude.'''
+    excl = np.unique(np.asarray(exclude, dtype=np.int64))
+    M = N - len(excl)
+    picks = (generator(rng).random_sample(n) * np.arange(M - n + 1, M + 1)).astype(np.int64).tolist()
+    taken = set()
+    out = []
+    for (j, t) in zip(xrange(M - n, M), picks):
+        k = j if t in taken else t
+        taken.add(k)
+        out.append(k)
+    out = np.array(out, dtype=np.int64)
+    # excluded integers at or below the i-th free one: those with excl[j] - j <= i
+    return out + np.searchsorted(excl - np.arange(len(excl)), out, side='right')
+
+def big_randrange(N, rng = None):
+    '''a uniform integer in range(N) for N beyond numpy integers,
+       made from 32 bit words drawn from the generator'''
+    bits = (N - 1).bit_length()
+    words = (bits + 31) // 32
+    while True:
+        k = 0
+        for w in generator(rng).randint(0, 2**32, size=words):
+            k = (k << 32) | int(w)
+        k >>= 32 * words - bits
+        if k < N:
+            return k
+
+def python_rejection_sample(N, n, exclude = [], rng = None):
+    '''rejection_sample for N beyond numpy integers'''
+    taken = set(exclude)
+    out = []
+    while len(out) < n:
+        k = big_randrange(N, rng)
+        if k not in taken:
+            taken.add(k)
+            out.append(k)
+    return out
+
+def sample_excluding(N, n, exclude = [], rng = None):
+    '''n distinct integers from range(N) that are not in exclude
+
+       exclude holds distinct integers. Returns a numpy array, or a
+       list if N is too large for numpy integers.'''
+    if n > N - len(exclude):
+        raise ValueError('sample larger than population')
+    if N > max_int:
+        return python_rejection_sample(N, n, exclude, rng)
+    if float(n + len(exclude)) / N <= dense_ratio:
+        return rejection_sample(N, n, exclude, rng)
+    return floyd_sample(N, n, exclude, rng)
+
     
 #############  Mixed radix
 # convert point in [a] x [b] x [c] x ... x [d] where 
@@ -182,5 +274,31 @@ if __name__ == "__main__":
         return True
 
     l = map(test_sampler, xrange(10000))
+
+    def test_sparse(i):
+        N = randint(1, 10000) if i % 2 else randint(1, 2**40)
+        e = randint(0, min(N, 20000))
+        exclude = list(worsample(N)) if N <= 20000 else []
+        exclude = exclude[:e] if exclude else list(set(randint(0, N-1) for _ in range(e)))
+        n = randint(0, N - len(exclude))
+        sample = sample_excluding(N, min(n, 20000), exclude)
+        s = set(list(sample))
+        assert(len(s) == len(sample) == min(n, 20000))
+        assert(len(s & set(exclude)) == 0)
+        assert(all(0 <= x < N for x in s))
+        return True
+
+    l = map(test_sparse, xrange(200))
     
         
+
+    def test_huge(i):
+        N = randint(2**63, 2**100)
+        exclude = [randint(0, N-1) for _ in range(10)]
+        a = sample_excluding(N, 50, exclude, np.random.RandomState(i))
+        assert(a == sample_excluding(N, 50, exclude, np.random.RandomState(i)))
+        assert(len(set(a)) == 50 and not set(a) & set(exclude))
+        assert(all(0 <= x < N for x in a))
+        return True
+
+    l = map(test_huge, xrange(100))
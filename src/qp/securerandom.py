@@ -0,0 +1,189 @@
+# random deviates from the entropy source of the operating system
+# (os.urandom), read in large blocks and kept in buffers that a
+# background thread keeps filled.
+
+__all__ = ['SecureRandomSource']
+
+import os
+import atexit
+import threading
+from logging import warning
+import numpy as np
+
+# A uniform is made from 53 random bits of a 64 bit word from
+# os.urandom, offset by half a step so that it lies in (0, 1) and the
+# logarithms of the Laplace inversion are finite. Integers are drawn
+# from masked words, rejecting those out of range, so that they are
+# exactly uniform. Binomial deviates, of which a histogram needs one,
+# are drawn by numpy from a state seeded with fresh entropy for each
+# call.
+
+class SecureRandomSource:
+    '''a generator (see distributions.generator) drawing from os.urandom
+
+       Uniforms are converted block words at a time, and up to
+       prefill Laplace(0, 1) deviates are kept ready. When a query
+       leaves less than half of them, a background thread makes new
+       ones, so that a query usually only copies deviates that are
+       already made. After a fork, the buffers are thrown away, so
+       that processes never share deviates. The thread is stopped at
+       exit, before the modules it uses are torn down.'''
+
+    fork_lock = threading.Lock() # only taken in a forked process
+
+    def __init__(self, block = 2**16, prefill = 2**18):
+        self.block = block
+        self.prefill = prefill
+        self.reset()
+        atexit.register(self.stop)
+
+    def reset(self):
+        '''empty buffers and a filling thread for this process'''
+        self.pid = os.getpid()
+        self.lock = threading.Lock() # the parent's may have been held when it forked
+        self.wanted = threading.Event()
+        self.pool = np.zeros(0) # uniforms
+        self.ready = np.zeros(0) # Laplace(0, 1) deviates
+        self.thread = None
+        self.stopped = False
+        if self.prefill > 0:
+            self.thread = threading.Thread(target = self.fill, name = 'SecureRandomSource')
+            self.thread.daemon = True
+            self.thread.start()
+            self.wanted.set()
+
+    def stop(self):
+        '''stop the filling thread'''
+        self.stopped = True
+        self.wanted.set()
+        if self.thread != None and self.thread.is_alive():
+            self.thread.join(5)
+
+    def check_fork(self):
+        if os.getpid() != self.pid:
+            with self.fork_lock:
+                if os.getpid() != self.pid:
+                    self.reset()
+
+    #### raw entropy
+
+    def words(self, n):
+        return np.frombuffer(os.urandom(8 * n), dtype=np.uint64)
+
+    def convert(self, n):
+        '''n fresh uniforms in (0, 1)'''
+        return ((self.words(n) >> np.uint64(11)) + 0.5) * (1.0 / 2**53)
+
+    def uniforms(self, n):
+        '''n uniforms in (0, 1), read from the pool'''
+        self.check_fork()
+        with self.lock:
+            if len(self.pool) < n:
+                self.pool = np.concatenate((self.pool, self.convert(max(self.block, n - len(self.pool)))))
+            (u, self.pool) = (self.pool[:n], self.pool[n:])
+        return u
+
+    #### Laplace deviates made ahead
+
+    def standard_laplace(self, u):
+        rr = np.minimum(u, 1 - u)
+        return np.where(u >= 0.5, -1, 1) * np.log(2 * rr)
+
+    def fill(self):
+        '''keep the buffer of Laplace deviates filled'''
+        while not self.stopped:
+            self.wanted.wait()
+            self.wanted.clear()
+            try:
+                while len(self.ready) < self.prefill and not self.stopped:
+                    more = self.standard_laplace(self.convert(min(self.block, self.prefill)))
+                    with self.lock:
+                        self.ready = np.concatenate((self.ready, more))
+            except Exception as e:
+                warning('Could not fill secure noise buffer: ' + str(e))
+
+    def take_laplace(self, n):
+        '''n Laplace(0, 1) deviates, from the buffer as far as it goes'''
+        self.check_fork()
+        with self.lock:
+            (x, self.ready) = (self.ready[:n], self.ready[n:])
+            low = len(self.ready) < self.prefill / 2
+        if low and self.thread != None:
+            self.wanted.set()
+        if len(x) < n:
+            x = np.concatenate((x, self.standard_laplace(self.uniforms(n - len(x)))))
+        return x
+
+    #### the numpy.random.RandomState methods used by distributions
+
+    def random_sample(self, size = None):
+        u = self.uniforms(1 if size == None else size)
+        return float(u[0]) if size == None else u
+
+    def uniform(self, low = 0.0, high = 1.0, size = None):
+        u = self.uniforms(1 if size == None else size)
+        x = low + (high - low) * u
+        return float(x[0]) if size == None else x
+
+    def laplace(self, loc = 0.0, scale = 1.0, size = None):
+        x = loc + scale * self.take_laplace(1 if size == None else size)
+        return float(x[0]) if size == None else x
+
+    def randint(self, low, high = None, size = None, dtype = np.int64):
+        if high == None:
+            (low, high) = (0, low)
+        span = int(high - low)
+        n = 1 if size == None else size
+        mask = np.uint64(2**max(1, (span - 1).bit_length()) - 1)
+        out = np.zeros(0, dtype=np.uint64)
+        while len(out) < n:
+            w = self.words(max(16, 2 * (n - len(out)))) & mask
+            out = np.concatenate((out, w[w < np.uint64(span)]))
+        x = (low + out[:n].astype(np.int64)).astype(dtype)
+        return x[0] if size == None else x
+
+    def geometric(self, p, size = None):
+        '''trials until the first success, by inversion'''
+        u = self.uniforms(1 if size == None else size)
+        x = 1 if p == 1 else np.floor(np.log1p(-u) / np.log1p(-p)).astype(np.int64) + 1
+        x = np.ones(len(u), dtype=np.int64) * x
+        return int(x[0]) if size == None else x
+
+    def binomial(self, n, p, size = None):
+        seed = np.frombuffer(os.urandom(624 * 4), dtype=np.uint32)
+        return np.random.RandomState(seed).binomial(n, p, size)
+
+
+if __name__ == "__main__":
+    import sys
+    from time import time, sleep
+    from distributions import rlaplace_n, rlaplace_tail_n
+
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    queries = 50
+
+    def bench(name, rng):
+        t = time()
+        for i in range(queries):
+            rlaplace_n(n, 2.0, rng = rng)
+        t = time() - t
+        print '%-30s %8.3f ms/query' % (name, 1e3 * t / queries)
+
+    print 'Laplace noise for %d cells per query' % n
+    bench('numpy.random', np.random)
+    bench('SecureRandomSource, no buffer', SecureRandomSource(prefill = 0))
+    g = SecureRandomSource(prefill = 4 * n)
+    sleep(0.5) # let the buffer fill
+    t = time()
+    x = rlaplace_n(n, 2.0, rng = g)
+    print '%-30s %8.3f ms/query' % ('SecureRandomSource, buffered', 1e3 * (time() - t))
+
+    # moments and bounds
+    x = rlaplace_n(10**6, 1.0, rng = SecureRandomSource(prefill = 0))
+    print 'Laplace(0, 1) mean %.4f variance %.4f (0, 2)' % (x.mean(), x.var())
+    assert(np.all(rlaplace_tail_n(1000, 2.0, 5, rng = g) >= 5))
+    r = g.randint(0, 3, 30000)
+    assert(r.min() == 0 and r.max() == 2)
+    print 'randint(0, 3) frequencies', np.bincount(r)
+    print 'geometric(0.25) mean %.3f (4)' % g.geometric(0.25, 10**5).mean()
+    print 'binomial(10**9, 1e-4) %d (10**5)' % g.binomial(10**9, 1e-4)
@@ -0,0 +1,136 @@
+# bounded worker pools for running queries off the reactor
+
+__all__ = ['ServerBusy', 'ThreadWorkers', 'ProcessWorkers', 'run_query']
+
+import signal
+import multiprocessing
+from twisted.internet import reactor, threads
+from twisted.internet.defer import Deferred
+from twisted.python.threadpool import ThreadPool
+
+from frontend import init_frontend, handle_query
+
+class ServerBusy(Exception):
+    '''raised when a pool has no room for another job'''
+    pass
+
+class Workers:
+    '''bookkeeping common to the pools
+
+       At most maxqueue jobs can be pending (queued or running). A
+       slot can be reserved ahead of submitting the job, e.g., before
+       asking the risk accountant, so that a granted query is never
+       turned away.'''
+
+    def __init__(self, size, maxqueue):
+        self.size = size
+        self.maxqueue = maxqueue
+        self.pending = 0
+
+    def reserve(self):
+        if self.pending >= self.maxqueue:
+            raise ServerBusy('Server busy, try again later.')
+        self.pending += 1
+
+    def release(self, result = None):
+        self.pending -= 1
+        return result
+
+    def submit(self, reserved, f, *args):
+        '''run f(*args) in the pool, returns a Deferred'''
+        if not reserved:
+            self.reserve()
+        d = self.run(f, *args)
+        d.addBoth(self.release)
+        return d
+
+
+class ThreadWorkers(Workers):
+    '''run jobs in a pool of threads'''
+
+    def __init__(self, size, maxqueue):
+        Workers.__init__(self, size, maxqueue)
+        self.pool = ThreadPool(1, size, 'query')
+        self.pool.start()
+        reactor.addSystemEventTrigger('during', 'shutdown', self.pool.stop)
+
+    def run(self, f, *args):
+        return threads.deferToThreadPool(reactor, self.pool, f, *args)
+
+    def query(self, frontend, eps, query, reserved = False):
+        '''handle_query(frontend, eps, query) in a thread'''
+        return self.submit(reserved, handle_query, frontend, eps, query)
+
+
+#### process pool. Each process has its own frontend (and so its
+#### own database connection), and runs queries through run_query.
+
+worker_frontend = None
+
+def init_worker(database, processors):
+    global worker_frontend
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGUSR1, signal.SIG_IGN)
+    worker_frontend = init_frontend(database, processors)
+
+def run_query(eps, query):
+    '''run handle_query in a worker process'''
+    try:
+        return (True, handle_query(worker_frontend, eps, query))
+    except Exception as e:
+        return (False, str(e))
+
+class ProcessWorkers(Workers):
+    '''run queries in a pool of processes
+
+       Only query types known when the pool was created can be run.
+       The pool should be made before any threads are started, as its
+       processes are forked. Each job is waited for in a thread, so
+       that a job that fails, or does not finish within timeout
+       seconds, fails its Deferred. The slot of a job that timed out is
+       only freed when the job is done, as it keeps its process busy
+       until then.'''
+
+    def __init__(self, size, maxqueue, database, processors, timeout = None):
+        Workers.__init__(self, size, maxqueue)
+        self.processors = set(processors.keys())
+        self.timeout = timeout
+        self.pool = multiprocessing.Pool(size, init_worker, (database, processors))
+        self.waiters = ThreadPool(0, maxqueue, 'process_wait')
+        self.waiters.start()
+        reactor.addSystemEventTrigger('during', 'shutdown', self.pool.terminate)
+        reactor.addSystemEventTrigger('during', 'shutdown', self.waiters.stop)
+
+    def submit(self, reserved, f, *args):
+        '''run f(*args) in a worker process, returns a Deferred.
+           f returns (ok, value)'''
+        if not reserved:
+            self.reserve()
+        d = Deferred()
+        self.waiters.callInThread(self.wait, self.pool.apply_async(f, args), d)
+        return d
+
+    def wait(self, result, d):
+        '''wait for a job in a waiter thread'''
+        result.wait(self.timeout)
+        if not result.ready():
+            reactor.callFromThread(d.errback, Exception('Query timed out.'))
+            result.wait()
+        try:
+            (ok, value) = result.get()
+        except Exception as e:
+            (ok, value) = (False, str(e))
+        reactor.callFromThread(self.done, d, ok, value)
+
+    def done(self, d, ok, value):
+        self.release()
+        if d.called: # timed out
+            return
+        if ok:
+            d.callback(value)
+        else:
+            d.errback(Exception(value))
+
+    def query(self, frontend, eps, query, reserved = False):
+        '''handle_query with the worker's own frontend in a process'''
+        return self.submit(reserved, run_query, eps, query)
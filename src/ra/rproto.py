@@ -32,6 +32,7 @@
 
 from twisted.internet import reactor
 from twisted.internet.protocol import Factory
+from twisted.internet.defer import Deferred, maybeDeferred
 from collections import defaultdict
 
 
@@ -63,7 +64,9 @@ class ServerState:
                  me,
                  database,
                  policies,
-                 policy):
+                 policy,
+                 batch_delay = 0,
+                 batch_size = 100):
 
         self.gpg = gpg # gpg instance
         self.me = me # my key identifier
@@ -74,14 +77,78 @@ class ServerState:
         self.con = self.backend['connection']
         self.users = self.backend['schema'].tables['users']
         self.history = self.backend['schema'].tables['history']        
+        self.totals = self.backend['schema'].tables['totals']
         self.policies = policies
         self.policy = policy
+        self.writer = HistoryWriter(self, batch_delay, batch_size)
 
         
     def reload_backend(self):
         self.loadf(self)
 
 
+class HistoryWriter:
+    '''group commit of granted risk expenditures
+
+       Grants are decided in the reactor thread against the stored
+       total plus what is pending in memory, so decisions are exact.
+       Pending rows are written to history (and totals) in one
+       transaction batch_delay seconds after the first of them arrived
+       (at the end of the current reactor iteration if batch_delay is
+       0), or as soon as batch_size rows are pending. The Deferred
+       returned by add fires when the row is committed.'''
+
+    def __init__(self, state, delay = 0, size = 100):
+        self.state = state
+        self.delay = delay
+        self.size = size
+        self.rows = []     # (user, eps, deferred)
+        self.pending = defaultdict(float) # user -> uncommitted spend
+        self.call = None
+
+    def spent(self, user):
+        '''uncommitted risk expenditure for user'''
+        return self.pending.get(user, 0.0)
+
+    def add(self, user, eps):
+        d = Deferred()
+        self.rows.append((user, eps, d))
+        self.pending[user] += eps
+        if len(self.rows) >= self.size:
+            self.flush()
+        elif self.call == None:
+            self.call = reactor.callLater(self.delay, self.flush)
+        return d
+
+    def flush(self):
+        if self.call != None and self.call.active():
+            self.call.cancel()
+        self.call = None
+        (rows, self.rows) = (self.rows, [])
+        (sums, self.pending) = (self.pending, defaultdict(float))
+        if not rows:
+            return
+        state = self.state
+        trans = state.con.begin()
+        try:
+            state.con.execute(state.history.insert(),
+                              [{'id' : u, 'eps' : e} for (u, e, _) in rows])
+            for (user, eps) in sums.items():
+                res = state.con.execute(state.totals.update().values(
+                    spent = state.totals.c.spent + eps).where(
+                        state.totals.c.id == user))
+                if res.rowcount == 0:
+                    state.con.execute(state.totals.insert().values(id=user, spent=eps))
+            trans.commit()
+        except Exception as e:
+            trans.rollback()
+            error('Could not record risk expenditures: ' + str(e))
+            map(lambda (u, e, d) : d.errback(Exception('History write failed.')), rows)
+            return
+        print 'committed', len(rows), 'expenditures'
+        map(lambda (u, e, d) : d.callback(None), rows)
+
+
 ### Protocols
 
 #### Server protocol for talking to clients
@@ -129,32 +196,39 @@ class ClientHandler:
             self.proto.sendMessage(RABadQuery(request))
             return
         self.request = r
-        try:
-            res = self.handler[r.type](r)
-            info('Served: ' + str((str(r), str(res))))
-            print('Served: ' + str((str(r), str(res))))
-            self.proto.sendMessage(res)
-        except Exception as e:
-            print 'exception:', e
-            self.proto.sendMessage(RAInternalError('Sorry.'))
-            
+        d = maybeDeferred(self.handler[r.type], r)
+        d.addCallbacks(lambda res : self.served(r, res),
+                       lambda f : self.failed(r, f))
+
+    def served(self, r, res):
+        res.rid = r.rid
+        info('Served: ' + str((str(r), str(res))))
+        print('Served: ' + str((str(r), str(res))))
+        self.proto.sendMessage(res)
+
+    def failed(self, r, failure):
+        print 'exception:', failure.getErrorMessage()
+        res = RAInternalError('Sorry.')
+        res.rid = r.rid
+        self.proto.sendMessage(res)
+
 
     def get_info(self, r):
-        res = list(self.proto.state.con.execute(
-            sa.select([self.proto.state.users.c.tt,
-                       self.proto.state.users.c.qt]).where(
-                           self.proto.state.users.c.id == r.user)))
+        state = self.proto.state
+        res = list(state.con.execute(
+            sa.select([state.users.c.tt,
+                       state.users.c.qt,
+                       state.totals.c.spent]).select_from(
+                           state.users.outerjoin(
+                               state.totals,
+                               state.users.c.id == state.totals.c.id)).where(
+                                   state.users.c.id == r.user)))
         if len(res) != 1:
             return None
-        row = res[0]
-        res = list(self.proto.state.con.execute(
-            sa.select([sa.func.sum(self.proto.state.history.c.eps)]).where(
-                       self.proto.state.history.c.id == r.user)))
-        used = 0.0
-        if res:
-            s = res[0][0]
-            used = float(s) if s != None else 0.0
-        return (used, row)
+        (tt, qt, s) = res[0]
+        used = float(s) if s != None else 0.0
+        used += state.writer.spent(r.user)
+        return (used, (tt, qt))
 
     def handle_check(self, r):
         user = self.get_info(r)
@@ -163,10 +237,11 @@ class ClientHandler:
         (total, (tt, qt)) = user
         ok = self.proto.state.policies[self.proto.state.policy]['implementation'](
             r.eps, tt, qt, total, []) 
-        if ok: # add to history
-            self.proto.state.con.execute(self.proto.state.history.insert().values(
-                id=r.user, eps=r.eps))
-        return RAOK(ok + 0)
+        if ok: # add to history, reply when committed
+            d = self.proto.state.writer.add(r.user, r.eps)
+            d.addCallback(lambda _ : RAOK(1))
+            return d
+        return RAOK(0)
 
     def handle_info(self, r):
         user = self.get_info(r)
@@ -200,8 +275,8 @@ def reload_backend(state):
 
 
 
-def init_factory(gpg, me, database, policy, module):
-    state = ServerState(gpg, me, database, policies, policy)
+def init_factory(gpg, me, database, policy, module, batch_delay = 0, batch_size = 100):
+    state = ServerState(gpg, me, database, policies, policy, batch_delay, batch_size)
     state.module = module
     state.loadf = reload_backend
     factory = ServerFactory(state)
@@ -186,10 +186,11 @@ class InfoQ(object):
 
 
 def init_resource(gpghome, key_id, qp_id, known_hosts, homepage,
-                  alias='Demo', usefp = False):
+                  alias='Demo', usefp = False, session = False,
+                  qp_connections = 2, max_in_flight = 16):
 
     gpg = gnupg.GPG(homedir=gpghome)
-    state = State(gpg, key_id, qp_id)
+    state = State(gpg, key_id, qp_id, session, qp_connections, max_in_flight)
 
     aliasid = alias
     if usefp:
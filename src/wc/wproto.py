@@ -42,66 +42,133 @@ import sys
 
 class State:
     '''information about the global state'''
-    def __init__(self, gpg, me, qp):
+    def __init__(self, gpg, me, qp, session = False, qp_connections = 2,
+                 max_in_flight = 16):
 
         self.gpg = gpg # gpg instance
         self.me = me # my key identifier
         self.qp = qp # query processor identifier
+        self.session = session # use session channels
+        self.qp_connections = qp_connections # connections per query processor
+        self.max_in_flight = max_in_flight # requests in flight per connection
+        self.connections = {} # (host, port) -> [QPConnection]
 
 
 #### Client protocol for talking to Query Processor
 
 class ClientProtocol(GPGProtocol):
+    '''persistent connection to a query processor'''
 
-    def __init__(self, state, qp_request, web_request, callback):
+    def __init__(self, connection):
+        state = connection.state
         GPGProtocol.__init__(self,
                              state.gpg,
                              state.me,
                              state.qp, # talk to qp 
-                             [state.qp]) # only allow responses from this qp
-        self.state = state
-        self.finished = False
-
-        # callback is called with (QPResponse, self.qp_request, self.web_request)
-        self.qp_request = qp_request      # the request to send
-        self.web_request = web_request    # the associated web request associated 
-        self.callback = callback # the responder that through method
-                                 # callback(message, request) takes care
-                                 # of the second half of the web
-                                 # resource rendering
-    
+                             [state.qp], # only allow responses from this qp
+                             session = state.session)
+        self.connection = connection
+
     def messageReceived(self, message):
-        r = QPResponse.parse(message)
-        self.finished = True
-        self.transport.loseConnection()
-        self.callback(r, self.qp_request, self.web_request)
+        self.connection.received(QPResponse.parse(message))
 
     def connectionMade(self):
-        self.sendMessage(self.qp_request)
-        
+        self.connection.connected(self)
 
     def connectionLost(self, reason):
-        if not self.finished:
-            self.callback(str(reason),
-                          self.qp_request,
-                          self.web_request) # signal connectionLost
+        self.connection.lost(str(reason))
 
 
 class QPClientFactory(ClientFactory):
-    def __init__(self, state, q_request, w_request, callback):
-        self.state = state
-        self.q_request = q_request
-        self.w_request = w_request
-        self.callback = callback
+    def __init__(self, connection):
+        self.connection = connection
         
     def buildProtocol(self, addr):
-        return ClientProtocol(self.state,
-                              self.q_request,
-                              self.w_request,
-                              self.callback)
+        return ClientProtocol(self.connection)
 
     def clientConnectionFailed(self, connector, reason):
-        self.callback(str(reason), self.q_request, self.w_request) # signal connectionLost
+        self.connection.lost(str(reason)) # signal connectionLost
+
+
+class QPConnection:
+    '''requests to a query processor pipelined over one connection
+
+       Each request is given an id, and the callback is called with
+       (QPResponse, qp_request, web_request) when the response with
+       that id comes in, or with a string giving the reason if the
+       connection is lost before that. Responses without an id are
+       taken to be in request order. At most state.max_in_flight
+       requests are sent before their responses come in, so that the
+       query processor does not turn them away as busy; further
+       requests wait.'''
+
+    def __init__(self, state, host, port, timeout=5):
+        self.state = state
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.proto = None
+        self.connecting = False
+        self.waiting = [] # requests to send when connected
+        self.pending = {} # rid -> (qp_request, web_request, callback)
+        self.backlog = [] # requests waiting for room in flight
+        self.in_flight = 0
+        self.last_id = 0
+
+    def send(self, qp_request, web_request, callback):
+        self.last_id += 1
+        qp_request.rid = self.last_id
+        self.pending[qp_request.rid] = (qp_request, web_request, callback)
+        if self.in_flight >= self.state.max_in_flight:
+            self.backlog.append(qp_request)
+            return
+        self.transmit(qp_request)
+
+    def transmit(self, qp_request):
+        self.in_flight += 1
+        if self.proto != None:
+            self.proto.sendMessage(qp_request)
+            return
+        self.waiting.append(qp_request)
+        if not self.connecting:
+            self.connecting = True
+            reactor.connectTCP(self.host, self.port, QPClientFactory(self),
+                               timeout=self.timeout)
+
+    def connected(self, proto):
+        self.connecting = False
+        self.proto = proto
+        waiting = self.waiting
+        self.waiting = []
+        for q in waiting:
+            proto.sendMessage(q)
+
+    def received(self, r):
+        if r == None:
+            error('Malformed response from QP.')
+            return
+        rid = r.rid
+        if rid == None and self.pending:
+            rid = min(self.pending.keys())
+        if not self.pending.has_key(rid):
+            warning('Response to unknown request: ' + str(r))
+            return
+        (qp_request, web_request, callback) = self.pending.pop(rid)
+        self.in_flight -= 1
+        if self.backlog:
+            self.transmit(self.backlog.pop(0))
+        callback(r, qp_request, web_request)
+
+    def lost(self, reason):
+        self.proto = None
+        self.connecting = False
+        self.waiting = []
+        self.backlog = []
+        self.in_flight = 0
+        pending = self.pending
+        self.pending = {}
+        for (qp_request, web_request, callback) in pending.values():
+            callback(reason, qp_request, web_request) # signal connectionLost
 
 
 # convenience wrapper to send_request
@@ -110,8 +177,11 @@ def make_sender(state, callback, timeout=5):
         return send_request(state, host, port, q, w, callback, timeout)
     return send
 
-# send a request        
+# send a request on the least loaded connection to the query processor
 def send_request(state, host, port, qp_request, web_request, callback, timeout=5):
-    factory = QPClientFactory(state, qp_request, web_request, callback)
-    return reactor.connectTCP(host, port, factory, timeout=timeout)
-           
+    key = (host, port)
+    if not state.connections.has_key(key):
+        state.connections[key] = [QPConnection(state, host, port, timeout)
+                                  for i in range(state.qp_connections)]
+    c = min(state.connections[key], key = lambda c : len(c.pending))
+    c.send(qp_request, web_request, callback)